@@ -6,10 +6,18 @@ import numpy.matlib
 import re
 from shutil import copyfile
 import os
+import time
+from data_io import read_data_from_file, check_no_upcast
+from input_pipeline import BatchPrefetcher, TFDataBatches
+from evaluation import AsyncEvaluator
+from checkpoint import (SPLIT_KEYS, AsyncCheckpointer, get_rng_state, set_rng_state, load_checkpoint,
+                        restore_checkpoint, restore_last_eval, snapshot_checkpoint)
+from model_export import export_model
+from hgnn_np import TaskClassGrouping, EmbeddingPool, task_graph_embeddings
 
 
 class MTDataset:
-    def __init__(self, data, label, task_interval, num_class, batch_size):
+    def __init__(self, data, label, task_interval, num_class, batch_size, seed=None):
         self.data = data
         self.data_dim = data.shape[1]
         self.label = np.reshape(label, [1, -1])
@@ -17,6 +25,7 @@ class MTDataset:
         self.num_task = task_interval.size - 1
         self.num_class = num_class
         self.batch_size = batch_size
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
         self.__build_index__()
 
     def __build_index__(self):
@@ -26,40 +35,64 @@ class MTDataset:
             end = self.task_interval[0, i + 1]
             for j in range(self.num_class):
                 index_list.append(np.arange(start, end)[np.where(self.label[0, start:end] == j)[0]])
-        self.index_list = index_list
+        # all buckets live in one flat index array so a whole batch can be addressed with a single fancy index
+        self.bucket_size = np.array([index.size for index in index_list], dtype=np.int64)
+        if np.any(self.bucket_size == 0):
+            raise ValueError('every task needs at least one training instance of every class')
+        self.bucket_start = np.concatenate([[0], np.cumsum(self.bucket_size)[:-1]])
+        self.index_list = np.concatenate(index_list)
         self.counter = np.zeros([1, self.num_task * self.num_class], dtype=np.int32)
-
-    def get_next_batch(self):
-        sampled_data = np.zeros([self.batch_size * self.num_class * self.num_task, self.data_dim],
-                                dtype=np.float32)
-        sampled_label = np.zeros([self.batch_size * self.num_class * self.num_task, self.num_class],
-                                 dtype=np.int32)
-        sampled_task_ind = np.zeros([1, self.batch_size * self.num_class * self.num_task], dtype=np.int32)
-        sampled_label_ind = np.zeros([1, self.batch_size * self.num_class * self.num_task], dtype=np.int32)
-        for i in range(self.num_task):
-            for j in range(self.num_class):
-                cur_ind = i * self.num_class + j
-                task_class_index = self.index_list[cur_ind]
-                sampled_ind = range(cur_ind * self.batch_size,
-                                    (cur_ind + 1) * self.batch_size)
-                sampled_task_ind[0, sampled_ind] = i
-                sampled_label_ind[0, sampled_ind] = j
-                sampled_label[sampled_ind, j] = 1
-                if task_class_index.size < self.batch_size:
-                    sampled_data[sampled_ind, :] = self.data[np.concatenate((task_class_index, task_class_index[
-                        np.random.randint(0, high=task_class_index.size,
-                                          size=self.batch_size - task_class_index.size)])), :]
-
-                elif self.counter[0, cur_ind] + self.batch_size < task_class_index.size:
-                    sampled_data[sampled_ind, :] = self.data[task_class_index[self.counter[0, cur_ind]:self.counter[
-                                                                                                           0, cur_ind] + self.batch_size],
-                                                   :]
-                    self.counter[0, cur_ind] = self.counter[0, cur_ind] + self.batch_size
-                else:
-                    sampled_data[sampled_ind, :] = self.data[task_class_index[-self.batch_size:], :]
-                    self.counter[0, cur_ind] = 0
-                    np.random.shuffle(self.index_list[cur_ind])
-        return sampled_data, sampled_label, sampled_task_ind, sampled_label_ind
+        num_ins = self.batch_size * self.num_class * self.num_task
+        # the batch layout is fixed (task-major, then class, then batch_size rows), so everything except the data
+        # rows is built once
+        self.sampled_task_ind = np.reshape(np.repeat(np.arange(self.num_task, dtype=np.int32),
+                                                     self.num_class * self.batch_size), [1, -1])
+        self.sampled_label_ind = np.reshape(np.tile(np.repeat(np.arange(self.num_class, dtype=np.int32), self.batch_size),
+                                                    self.num_task), [1, -1])
+        self.sampled_label = np.zeros([num_ins, self.num_class], dtype=np.float32)
+        self.sampled_label[np.arange(num_ins), self.sampled_label_ind[0]] = 1
+        self.sampled_data = np.zeros([num_ins, self.data_dim], dtype=np.float32)
+
+    def get_next_batch_index(self):
+        counter = self.counter[0]
+        offset = np.arange(self.batch_size)
+        is_small = self.bucket_size < self.batch_size
+        is_last = ~is_small & (counter + self.batch_size >= self.bucket_size)
+        position = np.where(is_last, self.bucket_size - self.batch_size, counter)[:, np.newaxis] + offset
+        if np.any(is_small):
+            small_size = self.bucket_size[is_small, np.newaxis]
+            position[is_small] = np.where(offset < small_size, offset, self.rng.randint(
+                0, high=small_size, size=[small_size.size, self.batch_size]))
+        sampled_index = self.index_list[self.bucket_start[:, np.newaxis] + position]
+        counter[~is_small] += self.batch_size
+        counter[is_last] = 0
+        for cur_ind in np.nonzero(is_last)[0]:
+            self.rng.shuffle(self.index_list[self.bucket_start[cur_ind]: self.bucket_start[cur_ind] + self.bucket_size[cur_ind]])
+        return np.reshape(sampled_index, [-1])
+
+    def get_state(self):
+        # copies, so a checkpoint can be written while sampling goes on
+        state = {'counter': self.counter.copy(), 'index_list': self.index_list.copy()}
+        state.update(get_rng_state(self.rng))
+        return state
+
+    def set_state(self, state):
+        self.counter[...] = state['counter']
+        self.index_list[...] = state['index_list']
+        set_rng_state(self.rng, state)
+
+    def allocate_batch(self):
+        return np.zeros_like(self.sampled_data),
+
+    def get_next_batch(self, sampled_data=None):
+        if sampled_data is None:
+            sampled_data = self.sampled_data
+        sampled_index = self.get_next_batch_index()
+        if self.data.dtype == sampled_data.dtype:
+            np.take(self.data, sampled_index, axis=0, out=sampled_data, mode='clip')
+        else:
+            sampled_data[...] = self.data[sampled_index]
+        return sampled_data, self.sampled_label, self.sampled_task_ind, self.sampled_label_ind
 
 
 class MTDataset_Split:
@@ -84,63 +117,47 @@ class MTDataset_Split:
                 index_list.append(np.arange(start, end)[index_array])
         self.index_list = index_list
 
-    def split(self, train_size):
+    def split_index(self, train_size):
         if train_size < 1:
             train_num = np.ceil(self.num_class_ins * train_size).astype(np.int32)
         else:
             train_num = np.ones([self.num_task, self.num_class], dtype=np.int32) * train_size
             train_num = np.maximum(1, np.minimum(train_num, self.num_class_ins - 10))
             train_num = train_num.astype(np.int32)
-        traindata = np.zeros([0, self.data_dim], dtype=np.float32)
-        testdata = np.zeros([0, self.data_dim], dtype=np.float32)
-        trainlabel = np.zeros([1, 0], dtype=np.int32)
-        testlabel = np.zeros([1, 0], dtype=np.int32)
+        index = np.arange(self.task_interval[0, 0], self.task_interval[0, -1])
+        task_class_ind = np.repeat(np.arange(self.num_task), np.diff(self.task_interval[0])) * self.num_class + \
+            self.label[0, index]
+        # sorting by (task, class) with a random tie-breaker shuffles every task-class bucket in one pass
+        order = np.lexsort((np.random.random(index.size), task_class_ind))
+        task_class_ind = task_class_ind[order]
+        rank = np.arange(index.size) - np.searchsorted(task_class_ind, task_class_ind)
+        is_train = rank < np.reshape(train_num, [-1])[task_class_ind]
+        train_index = index[order[is_train]]
+        test_index = index[order[~is_train]]
         train_task_interval = np.zeros([1, self.num_task + 1], dtype=np.int32)
         test_task_interval = np.zeros([1, self.num_task + 1], dtype=np.int32)
-        for i in range(self.num_task):
-            for j in range(self.num_class):
-                cur_ind = i * self.num_class + j
-                task_class_index = self.index_list[cur_ind]
-                np.random.shuffle(task_class_index)
-                train_index = task_class_index[0:train_num[i, j]]
-                test_index = task_class_index[train_num[i, j]:]
-                traindata = np.concatenate((traindata, self.data[train_index, :]), axis=0)
-                trainlabel = np.concatenate((trainlabel, np.ones([1, train_index.size], dtype=np.int32) * j), axis=1)
-                testdata = np.concatenate((testdata, self.data[test_index, :]), axis=0)
-                testlabel = np.concatenate((testlabel, np.ones([1, test_index.size], dtype=np.int32) * j), axis=1)
-            train_task_interval[0, i + 1] = trainlabel.size
-            test_task_interval[0, i + 1] = testlabel.size
+        train_task_interval[0, 1:] = np.cumsum(np.bincount(task_class_ind[is_train] // self.num_class,
+                                                           minlength=self.num_task))
+        test_task_interval[0, 1:] = np.cumsum(np.bincount(task_class_ind[~is_train] // self.num_class,
+                                                          minlength=self.num_task))
+        return train_index, train_task_interval, test_index, test_task_interval
+
+    def split(self, train_size):
+        return self.take(*self.split_index(train_size))
+
+    def take(self, train_index, train_task_interval, test_index, test_task_interval):
+        traindata = self.data[train_index, :]
+        testdata = self.data[test_index, :]
+        trainlabel = np.reshape(self.label[0, train_index].astype(np.int32), [1, -1])
+        testlabel = np.reshape(self.label[0, test_index].astype(np.int32), [1, -1])
         return traindata, trainlabel, train_task_interval, testdata, testlabel, test_task_interval
 
 
-def read_data_from_file(filename):
-    file = open(filename, 'r')
-    contents = file.readlines()
-    file.close()
-    num_task = int(contents[0])
-    num_class = int(contents[1])
-    temp_ind = re.split(',', contents[2])
-    temp_ind = [int(elem) for elem in temp_ind]
-    task_interval = np.reshape(np.array(temp_ind), [1, -1])
-    temp_data = []
-    for pos in range(3, len(contents) - 1):
-        temp_sub_data = re.split(',', contents[pos])
-        temp_sub_data = [float(elem) for elem in temp_sub_data]
-        temp_data.append(temp_sub_data)
-    data = np.array(temp_data)
-    temp_label = re.split(',', contents[-1])
-    temp_label = [int(elem) for elem in temp_label]
-    label = np.reshape(np.array(temp_label), [1, -1])
-    return data, label, task_interval, num_task, num_class
-
-
-def compute_train_loss(i, feature_representation, hidden_output_weight, inputs_data_label, inputs_task_ind,
-                       inputs_num_ins_per_task, train_loss):
-    train_loss += tf.div(tf.losses.softmax_cross_entropy(tf.expand_dims(inputs_data_label[i, :], 0),
-                                                         tf.matmul(tf.expand_dims(feature_representation[inputs_task_ind[0, i]][i % (batch_size * inputs_data_label.shape[-1])][:], 0),
-                                                                   hidden_output_weight[inputs_task_ind[0, i], :, :])),
-                         tf.cast(inputs_num_ins_per_task[0, inputs_task_ind[0, i]], dtype=tf.float32))
-    return i + 1, feature_representation, hidden_output_weight, inputs_data_label, inputs_task_ind, inputs_num_ins_per_task, train_loss
+def compute_train_loss(logits, inputs_data_label, inputs_num_ins_per_task):
+    # logits are [num_task, rows_per_task, num_class] in the task-major batch layout
+    cross_entropy = tf.nn.softmax_cross_entropy_with_logits_v2(labels=tf.reshape(inputs_data_label, tf.shape(logits)),
+                                                               logits=logits)
+    return tf.reduce_sum(tf.reduce_sum(cross_entropy, 1) / tf.cast(inputs_num_ins_per_task[0], dtype=tf.float32))
 
 
 def gradient_clipping_tf_false_consequence(optimizer, obj, gradient_clipping_threshold):
@@ -162,7 +179,7 @@ def gradient_clipping_tf(optimizer, obj, option, gradient_clipping_threshold):
 def generate_label_task_ind(label, task_interval, num_class):
     num_task = task_interval.size - 1
     num_ins = label.size
-    label_matrix = np.zeros((num_ins, num_class), dtype=np.int32)
+    label_matrix = np.zeros((num_ins, num_class), dtype=np.float32)
     label_matrix[range(num_ins), label] = 1
     task_ind = np.zeros((1, num_ins), dtype=np.int32)
     for i in range(num_task):
@@ -171,16 +188,14 @@ def generate_label_task_ind(label, task_interval, num_class):
 
 
 def compute_errors(hidden_rep, hidden_output_weight, task_ind, label, num_task):
-    num_total_ins = hidden_rep.shape[0]
-    num_ins = np.zeros([1, num_task])
-    errors = np.zeros([1, num_task + 1])
-    for i in range(num_total_ins):
-        probit = np.matmul(hidden_rep[i, :], hidden_output_weight[task_ind[0, i], :, :])
-        num_ins[0, task_ind[0, i]] += 1
-        if np.argmax(probit) != label[0, i]:
-            errors[0, task_ind[0, i]] += 1
+    task_ind = task_ind[0]
+    wrong = np.zeros(task_ind.size)
+    # one matmul per task instead of one per test instance
     for i in range(num_task):
-        errors[0, i] = errors[0, i] / num_ins[0, i]
+        rows = np.flatnonzero(task_ind == i)
+        wrong[rows] = np.argmax(np.matmul(hidden_rep[rows], hidden_output_weight[i]), 1) != label[0, rows]
+    errors = np.zeros([1, num_task + 1])
+    errors[0, 0: num_task] = np.bincount(task_ind, wrong, num_task) / np.bincount(task_ind, minlength=num_task)
     errors[0, num_task] = np.mean(errors[0, 0: num_task])
     return errors
 
@@ -190,31 +205,138 @@ def change_datastruct(hidden_features, num_task):
 
 
 def compute_pairwise_dist_tf(data):
-    sq_data_norm = tf.reduce_sum(tf.square(data), axis=1)
-    sq_data_norm = tf.reshape(sq_data_norm, [-1, 1])
+    # works on a single [n, d] matrix or on a [num_task, n, d] batch of them
+    sq_data_norm = tf.reduce_sum(tf.square(data), axis=-1, keepdims=True)
     dist_matrix = sq_data_norm - 2 * tf.matmul(data, data, transpose_b=True) + tf.matrix_transpose(sq_data_norm)
     return dist_matrix
 
 
-def compute_pairwise_dist_np(data):
-    n = data.shape[0]
-    sq_data_norm = np.sum(data ** 2, axis=1)
-    sq_data_norm = np.reshape(sq_data_norm, [-1, 1])
-    dist_matrix = sq_data_norm - 2 * np.dot(data, data.transpose()) + sq_data_norm.transpose()
-    return dist_matrix
+def compute_sign_matrix(inputs_data_label, num_task):
+    new_inputs_data_label = change_datastruct(inputs_data_label, num_task)
+    return 2 * tf.matmul(new_inputs_data_label, new_inputs_data_label, transpose_b=True) - 1
 
 
-def compute_adjacency_matrix(hidden_features, inputs_data_label, num_task):
-    new_hidden_features = change_datastruct(hidden_features, num_task)
-    new_inputs_data_label = change_datastruct(inputs_data_label, num_task)
-    adjacency_matrixs = []
-    for i in range(num_task):
-        dist_matrix = -compute_pairwise_dist_tf(new_hidden_features[i])
-        sign_matrix = 2 * tf.matmul(new_inputs_data_label[i], tf.matrix_transpose(new_inputs_data_label[i])) - 1
-        adjacency_matrix = tf.exp(dist_matrix) * sign_matrix
-        adjacency_matrixs.append(adjacency_matrix)
-    adjacency_matrixs = tf.stack(adjacency_matrixs)
-    return adjacency_matrixs
+def get_block_sign_matrix(num_class, batch_size):
+    # MTDataset batches are task-major, class-major blocks of batch_size rows, so two rows of a task share a label
+    # exactly when they sit in the same diagonal block; the [B, B] result broadcasts over the task axis and only
+    # depends on constants, so it is folded once when the graph is optimized
+    block_id = tf.constant(np.repeat(np.arange(num_class, dtype=np.int32), batch_size))
+    return 2 * tf.cast(tf.equal(tf.expand_dims(block_id, 1), tf.expand_dims(block_id, 0)), tf.float32) - 1
+
+
+def get_block_node_class(num_task, num_class, batch_size):
+    # class of every row of a task under the MTDataset batch layout: row r sits in class block r // batch_size
+    return tf.constant(np.tile(np.repeat(np.arange(num_class, dtype=np.int32), batch_size), [num_task, 1]))
+
+
+def compute_node_class(inputs_data_label, num_task):
+    return tf.argmax(change_datastruct(inputs_data_label, num_task), -1, output_type=tf.int32)
+
+
+def map_row_tiles(tile_fn, num_rows, dtype):
+    # runs tile_fn(start, tiles) over row tiles of adjacency_tile_size rows, one tile at a time, and concatenates the
+    # [tile, num_task, k] pieces it writes back into [num_task, n, k]; the loop itself has no gradient
+    _, tiles = tf.while_loop(lambda start, _: start < num_rows, tile_fn,
+                             [tf.constant(0), tf.TensorArray(dtype, size=0, dynamic_size=True, infer_shape=False)],
+                             parallel_iterations=1, back_prop=False)
+    return tf.transpose(tiles.concat(), [1, 0, 2])
+
+
+def select_neighbours(features, num_neighbours):
+    # indices [num_task, n, num_neighbours] of the nearest rows of every row of features [num_task, n, d], the row
+    # itself included. The distances are built one [num_task, adjacency_tile_size, n] row tile at a time and dropped
+    # after its top_k, so no [num_task, n, n] tensor exists; 2 <f_i, f_j> - ||f_j||^2 ranks a row like
+    # -||f_i - f_j||^2
+    sq_norm = tf.expand_dims(tf.reduce_sum(tf.square(features), -1), 1)
+
+    def select_tile(start, tiles):
+        score = 2 * tf.matmul(features[:, start: start + adjacency_tile_size], features, transpose_b=True) - sq_norm
+        tile_index = tf.transpose(tf.nn.top_k(score, num_neighbours).indices, [1, 0, 2])
+        return start + adjacency_tile_size, tiles.write(start // adjacency_tile_size, tile_index)
+
+    return map_row_tiles(select_tile, tf.shape(features)[1], tf.int32)
+
+
+def neighbour_dot(a, b, neighbour_index):
+    # <a_i, b_j> [num_task, n, k] for every row i of a and each of its neighbours j; the neighbour rows of b are
+    # gathered one [num_task, adjacency_tile_size, k, d] tile at a time, never for the whole batch
+    def dot_tile(start, tiles):
+        stop = start + adjacency_tile_size
+        neighbour_rows = tf.gather(b, neighbour_index[:, start: stop], batch_dims=1)
+        dot = tf.einsum('tid,tikd->tik', a[:, start: stop], neighbour_rows)
+        return stop, tiles.write(start // adjacency_tile_size, tf.transpose(dot, [1, 0, 2]))
+
+    return map_row_tiles(dot_tile, tf.shape(a)[1], a.dtype)
+
+
+def neighbour_adjacency(neighbour_index, neighbour_weight):
+    # sparse_dense_matmul only takes rank-2 operands, so the per-task neighbour lists become one block-diagonal
+    # sparse matrix over every row of the batch
+    shape = tf.shape(neighbour_index, out_type=tf.int64)
+    num_rows = shape[0] * shape[1]
+    row = tf.tile(tf.reshape(tf.range(num_rows), [-1, 1]), [1, shape[2]])
+    column = tf.cast(neighbour_index, tf.int64) + tf.reshape(tf.range(shape[0]) * shape[1], [-1, 1, 1])
+    return tf.SparseTensor(tf.stack([tf.reshape(row, [-1]), tf.reshape(column, [-1])], 1),
+                           tf.reshape(neighbour_weight, [-1]), tf.stack([num_rows, num_rows]))
+
+
+def neighbour_sq_dist(features, neighbour_index):
+    # ||f_i||^2 + ||f_j||^2 - 2 <f_i, f_j> of the selected pairs. The gradient is written out as sparse products:
+    # for row m it is 2 (f_m (out_m + in_m) - sum_k g_mk f_j(m,k) - sum_{j(i,k) = m} g_ik f_i), out and in being the
+    # row and column sums of the upstream gradient g, so the backward pass gathers no neighbour rows either
+    @tf.custom_gradient
+    def sq_dist(features):
+        sq_norm = tf.reduce_sum(tf.square(features), -1)
+        dist = tf.expand_dims(sq_norm, 2) + tf.gather(sq_norm, neighbour_index, batch_dims=1) - 2 * neighbour_dot(
+            features, features, neighbour_index)
+
+        def grad(upstream):
+            adjacency = neighbour_adjacency(neighbour_index, upstream)
+            flat_features = tf.reshape(features, [-1, features.shape[-1]])
+            out_sum = tf.reshape(tf.reduce_sum(upstream, -1), [-1, 1])
+            in_sum = tf.sparse.sparse_dense_matmul(adjacency, tf.ones_like(out_sum), adjoint_a=True)
+            feature_grad = 2 * (flat_features * (out_sum + in_sum) - tf.sparse.sparse_dense_matmul(
+                adjacency, flat_features) - tf.sparse.sparse_dense_matmul(adjacency, flat_features, adjoint_a=True))
+            return tf.reshape(feature_grad, tf.shape(features))
+
+        return dist, grad
+
+    return sq_dist(features)
+
+
+def compute_adjacency_matrix(hidden_features, sign_matrix, num_task):
+    # in top-k mode sign_matrix is the [num_task, n] class of every row instead, see get_block_node_class and
+    # compute_node_class, so the label sign is only formed at the selected neighbours
+    features = change_datastruct(hidden_features, num_task)
+    if not top_k_neighbours:
+        return tf.exp(-compute_pairwise_dist_tf(features)) * sign_matrix
+    # keep the top_k_neighbours nearest rows of every node, the node itself included, as (index, weight) lists
+    neighbour_index = select_neighbours(features, top_k_neighbours)
+    same_class = tf.equal(tf.expand_dims(sign_matrix, 2), tf.gather(sign_matrix, neighbour_index, batch_dims=1))
+    return neighbour_index, tf.exp(-neighbour_sq_dist(features, neighbour_index)) * (2 * tf.cast(same_class, tf.float32) - 1)
+
+
+def message_passing(adjacency_matrix, features):
+    if not top_k_neighbours:
+        return tf.matmul(adjacency_matrix, features)
+    neighbour_index, neighbour_weight = adjacency_matrix
+
+    # TensorFlow's own gradient of sparse_dense_matmul with respect to the weights gathers a [nnz, d] row pair per
+    # entry; <upstream_i, f_j> is taken tile by tile instead
+    @tf.custom_gradient
+    def sparse_messages(neighbour_weight, features):
+        adjacency = neighbour_adjacency(neighbour_index, neighbour_weight)
+        hidden_dim = features.shape[-1]
+        messages = tf.sparse.sparse_dense_matmul(adjacency, tf.reshape(features, [-1, hidden_dim]))
+
+        def grad(upstream):
+            feature_grad = tf.sparse.sparse_dense_matmul(adjacency, tf.reshape(upstream, [-1, hidden_dim]),
+                                                         adjoint_a=True)
+            return neighbour_dot(upstream, features, neighbour_index), tf.reshape(feature_grad, tf.shape(features))
+
+        return tf.reshape(messages, tf.shape(features)), grad
+
+    return sparse_messages(neighbour_weight, features)
 
 
 def activate_function(temp, activate_op):
@@ -249,23 +371,46 @@ def GAT(attention_weight, embedding_vectors):
     return attention_values
 
 
+def augment_features(hidden_features, task_embedding_vectors, class_embedding_vectors, num_task, num_class):
+    # every row of task i carries task embedding i and every row of its class block j carries class embedding
+    # i * num_task + j, so both are tiled from the embedding tensors instead of stacked row by row
+    hidden_features = change_datastruct(hidden_features, num_task)
+    rows_per_task = tf.shape(hidden_features)[1]
+    task_features = tf.tile(tf.expand_dims(task_embedding_vectors, 1), [1, rows_per_task, 1])
+    class_index = np.reshape(np.arange(num_task) * num_task, [-1, 1]) + np.arange(num_class)
+    class_features = tf.tile(tf.expand_dims(tf.gather(class_embedding_vectors, class_index), 2),
+                             [1, 1, rows_per_task // num_class, 1])
+    class_features = tf.reshape(class_features, [num_task, -1, class_embedding_vectors.shape[-1]])
+    return tf.concat([hidden_features, task_features, class_features], 2)
+
+
+def compute_logits(feature_parts, hidden_output_weight, num_task, num_class):
+    hidden_features, task_embedding_vectors, class_embedding_vectors = feature_parts
+    if not decompose_logits:
+        return tf.matmul(augment_features(hidden_features, task_embedding_vectors, class_embedding_vectors, num_task,
+                                          num_class), hidden_output_weight)
+    # the output layer is linear over [hidden, task embedding, class embedding]; the task and class parts are
+    # constant within a class block, so their logits are computed once per task and per class and broadcast-added
+    hidden_dim = hidden_features.shape[-1]
+    class_start = hidden_dim + task_embedding_vectors.shape[-1]
+    hidden_logits = tf.matmul(change_datastruct(hidden_features, num_task), hidden_output_weight[:, :hidden_dim])
+    task_logits = tf.matmul(tf.expand_dims(task_embedding_vectors, 1), hidden_output_weight[:, hidden_dim: class_start])
+    class_index = np.reshape(np.arange(num_task) * num_task, [-1, 1]) + np.arange(num_class)
+    class_logits = tf.matmul(tf.gather(class_embedding_vectors, class_index), hidden_output_weight[:, class_start:])
+    logits = tf.reshape(hidden_logits, [num_task, num_class, -1, num_class]) + tf.expand_dims(task_logits + class_logits, 2)
+    return tf.reshape(logits, [num_task, -1, num_class])
+
+
 def get_feature_representation(inputs, input_hidden_weights, hidden_features, adjacency_matrix, num_task, num_class, activate_op,
-                            first_task_att_w, first_class_att_w, task_attention_weight, class_attention_weight, inputs_data_label):
+                            first_task_att_w, first_class_att_w, task_attention_weight, class_attention_weight, sign_matrix):
     hidden_representation = activate_function(
         tf.add(change_datastruct(tf.matmul(inputs, input_hidden_weights), num_task),
-               tf.matmul(adjacency_matrix, change_datastruct(hidden_features, num_task))), activate_op)
+               message_passing(adjacency_matrix, change_datastruct(hidden_features, num_task))), activate_op)
 
-    new_inputs_data_label = change_datastruct(inputs_data_label, num_task)
-    new_adjacency_matrix = []
-    for i in range(num_task):
-        dist_matrix = -compute_pairwise_dist_tf(hidden_representation[i])
-        sign_matrix = 2 * tf.matmul(new_inputs_data_label[i], tf.matrix_transpose(new_inputs_data_label[i])) - 1
-        adjacency_matrix = tf.exp(dist_matrix) * sign_matrix
-        new_adjacency_matrix.append(adjacency_matrix)
-    new_adjacency_matrix = tf.stack(new_adjacency_matrix)
+    new_adjacency_matrix = compute_adjacency_matrix(hidden_representation, sign_matrix, num_task)
     new_hidden_representation = activate_function(
         tf.add(change_datastruct(tf.matmul(inputs, input_hidden_weights), num_task),
-               tf.matmul(new_adjacency_matrix, hidden_representation)), activate_op)
+               message_passing(new_adjacency_matrix, hidden_representation)), activate_op)
 
     task_embedding_vectors = tf.reduce_max(new_hidden_representation, 1, name='task_embedding_vectors')
     task_attention_values = GAT(first_task_att_w, task_embedding_vectors)
@@ -273,31 +418,16 @@ def get_feature_representation(inputs, input_hidden_weights, hidden_features, ad
     task_attention_values = GAT(task_attention_weight, new_task_embedding_vectors)
     new_task_embedding_vectors = tf.tanh(tf.matmul(task_attention_values, tf.matmul(new_task_embedding_vectors, task_attention_weight)))
 
-    class_embedding_vectors = []
-    for i in range(num_task):
-        class_hidden_rep = tf.reshape(new_hidden_representation[i], [num_class, -1, new_hidden_representation.shape[-1]])
-        for j in range(num_class):
-            class_embedding_vectors.append(tf.reduce_max(class_hidden_rep[j], 0))
-    class_embedding_vectors = tf.stack(class_embedding_vectors)
+    # the representation is laid out task-major, then class-major, so one reshape exposes every class block
+    hidden_dim = new_hidden_representation.shape[-1]
+    class_embedding_vectors = tf.reshape(tf.reduce_max(tf.reshape(
+        new_hidden_representation, [num_task, num_class, -1, hidden_dim]), 2), [num_task * num_class, hidden_dim])
     class_attention_values = GAT(first_class_att_w, class_embedding_vectors)
     new_class_embedding_vectors = tf.tanh(tf.matmul(class_attention_values, tf.matmul(class_embedding_vectors, first_class_att_w)))
     class_attention_values = GAT(class_attention_weight, new_class_embedding_vectors)
     new_class_embedding_vectors = tf.tanh(tf.matmul(class_attention_values, tf.matmul(new_class_embedding_vectors, class_attention_weight)))
 
-    feature_representations = []
-    for i in range(num_task):
-        feature_representation = []
-        feature_representation_1 = tf.concat([
-            hidden_features[i * batch_size * num_class: (i + 1) * batch_size * num_class],
-            tf.stack([new_task_embedding_vectors[i] for _ in range(num_class * batch_size)])], 1)
-        for j in range(num_class):
-            feature_representation_2 = tf.concat([
-                feature_representation_1[j * batch_size: (j + 1) * batch_size],
-                tf.stack([new_class_embedding_vectors[i * num_task + j] for _ in range(batch_size)])], 1)
-            feature_representation.append(feature_representation_2)
-        feature_representations.append(feature_representation)
-    feature_representations = tf.stack(feature_representations)
-    return tf.reshape(feature_representations, [num_task, -1, hidden_features.shape[-1] + F_pie_t + F_pie_c])
+    return hidden_features, new_task_embedding_vectors, new_class_embedding_vectors
 
 
 def np_softmax(x):
@@ -307,44 +437,12 @@ def np_softmax(x):
     return softmax_x
 
 
-def get_embedding_vec(traindata, input_hidden_weights, first_task_att_w, first_class_att_w, task_attention_weight, class_attention_weight, train_hidden_features, train_label_matrix, train_task_ind, train_num_ins_per_task, num_task,  num_class):
-    inputs = [[] for _ in range(num_task)]
-    features = [[] for _ in range(num_task)]
-    labels = [[] for _ in range(num_task)]
-    for i in range(traindata.shape[0]):
-        inputs[train_task_ind[0, i]].append(traindata[i])
-        features[train_task_ind[0, i]].append(train_hidden_features[i])
-        labels[train_task_ind[0, i]].append(train_label_matrix[i])
-    task_embedding_vectors = []
-    class_embedding_vectors = []
-    for i in range(num_task):
-        dist_matrix = -compute_pairwise_dist_np(np.stack(features[i]))
-        sign_matrix = 2 * np.matmul(np.stack(labels[i]), np.transpose(np.stack(labels[i]))) - 1
-        adjacency_matrix = np.exp(dist_matrix) * sign_matrix
-        new_features = np.tanh(np.add(np.matmul(np.stack(inputs[i]), input_hidden_weights),
-                                      np.matmul(adjacency_matrix, np.stack(features[i]))))
-        new_dist_matrix = -compute_pairwise_dist_np(new_features)
-        new_adjacency_matrix = np.exp(new_dist_matrix) * sign_matrix
-        new_features = np.tanh(np.add(np.matmul(np.stack(inputs[i]), input_hidden_weights),
-                                      np.matmul(new_adjacency_matrix, new_features)))
-
-        task_embedding_vector = np.max(new_features, 0)
-        task_embedding_vectors.append(task_embedding_vector)
-        inputs_class = [[] for _ in range(num_class)]
-        features_class = [[] for _ in range(num_class)]
-        labels_class = [[] for _ in range(num_class)]
-        for j in range(len(inputs[i])):
-            inputs_class[np.int(np.argmax(labels[i][j]))].append(inputs[i][j])
-            features_class[np.int(np.argmax(labels[i][j]))].append(features[i][j])
-            labels_class[np.int(np.argmax(labels[i][j]))].append(labels[i][j])
-        for j in range(num_class):
-            dist_matrix = -compute_pairwise_dist_np(np.stack(features_class[j]))
-            sign_matrix = 2 * np.matmul(np.stack(labels_class[j]), np.transpose(np.stack(labels_class[j]))) - 1
-            adjacency_matrix = np.exp(dist_matrix) * sign_matrix
-            new_features = np.tanh(np.add(np.matmul(np.stack(inputs_class[j]), input_hidden_weights),
-                                          np.matmul(adjacency_matrix, np.stack(features_class[j]))))
-            class_embedding_vector = np.max(new_features, 0)
-            class_embedding_vectors.append(class_embedding_vector)
+def get_embedding_vec(traindata, input_hidden_weights, first_task_att_w, first_class_att_w, task_attention_weight, class_attention_weight, train_hidden_features, train_groups, num_task,  num_class, eval_pool=None):
+    input_hidden = train_groups.gather(np.matmul(traindata, input_hidden_weights))
+    train_hidden_features = train_groups.gather(train_hidden_features)
+    task_embedding_vectors, class_embedding_vectors = task_graph_embeddings(input_hidden, train_hidden_features, train_groups,
+                                                                            num_class, eval_tile_size, eval_pool,
+                                                                            top_k_neighbours)
     task_attention_values = np_softmax(get_normed_distance_np(np.stack(task_embedding_vectors)))
     new_task_embedding_vectors = np.tanh(np.matmul(task_attention_values, np.matmul(task_embedding_vectors, first_task_att_w)))
     task_attention_values = np_softmax(get_normed_distance_np(np.stack(new_task_embedding_vectors)))
@@ -358,28 +456,30 @@ def get_embedding_vec(traindata, input_hidden_weights, first_task_att_w, first_c
     return new_task_embedding_vectors, new_class_embedding_vectors
 
 
-def get_new_hidden_features(test_hidden_rep, task_embedding_vectors, class_embedding_vectors, hidden_output_weight, test_task_ind, num_task, num_class):
-    temp_test_hidden_rep = []
-    for i in range(test_hidden_rep.shape[0]):
-        temp = np.concatenate([test_hidden_rep[i], task_embedding_vectors[test_task_ind[0, i]]], 0)
-        temp_test_hidden_rep.append(temp)
-    temp_test_hidden_rep = np.stack(temp_test_hidden_rep)
-    test_hidden_rep = []
-    for i in range(len(temp_test_hidden_rep)):
-        task_id = test_task_ind[0, i]
-        probits_softmax = []
-        for j in range(num_class):
-            temp = np.concatenate([temp_test_hidden_rep[i], class_embedding_vectors[task_id * num_task + j]], 0)
-            probit_softmax = np_softmax(np.matmul(temp, hidden_output_weight[task_id]))
-            probits_softmax.append(probit_softmax)
-        probits_softmax = np.stack(probits_softmax)
-        diagonal = []
-        for j in range(num_class):
-            diagonal.append(probits_softmax[j][j])
-        class_id = np.argmax(diagonal)
-        test_hidden_rep.append(np.concatenate([temp_test_hidden_rep[i], class_embedding_vectors[task_id * num_class + class_id]], 0))
-    test_hidden_rep = np.stack(test_hidden_rep)
-    return test_hidden_rep
+def get_new_hidden_features(test_hidden_rep, task_embedding_vectors, class_embedding_vectors, hidden_output_weight, test_task_ind, num_task, num_class,
+                            chunk_size=256):
+    task_ind = test_task_ind[0]
+    hidden_dim = test_hidden_rep.shape[1]
+    class_start = hidden_dim + task_embedding_vectors.shape[1]
+    class_id = np.zeros(task_ind.size, dtype=np.int64)
+    # the output layer is linear over [hidden, task embedding, class embedding], so the logits of candidate class j
+    # are a per-sample part shared by every candidate plus a per-(task, j) part that is computed once per task
+    for i in range(num_task):
+        rows = np.flatnonzero(task_ind == i)
+        weight = hidden_output_weight[i]
+        shared_logits = np.matmul(test_hidden_rep[rows], weight[:hidden_dim]) + np.matmul(
+            task_embedding_vectors[i], weight[hidden_dim: class_start])
+        candidate_logits = np.matmul(class_embedding_vectors[i * num_task + np.arange(num_class)], weight[class_start:])
+        for start in range(0, rows.size, chunk_size):
+            # logits[s, j, k]: sample s scored with the embedding of candidate j; candidate j is ranked by the log of
+            # its own softmax entry k = j
+            logits = shared_logits[start: start + chunk_size, None, :] + candidate_logits
+            max_logits = np.max(logits, 2, keepdims=True)
+            log_normalizer = max_logits[:, :, 0] + np.log(np.sum(np.exp(logits - max_logits), 2))
+            diagonal = np.diagonal(logits, axis1=1, axis2=2) - log_normalizer
+            class_id[rows[start: start + chunk_size]] = np.argmax(diagonal, 1)
+    return np.concatenate([test_hidden_rep, task_embedding_vectors[task_ind],
+                           class_embedding_vectors[task_ind * num_class + class_id]], 1)
 
 
 @function.Defun(dtypes.float32, dtypes.float32)
@@ -415,19 +515,35 @@ def TensorTraceNorm(X, method='Tucker'):
         re = [nuclear_norm(TensorUnfold(X, 0))]
     return tf.reduce_mean(tf.stack(re))
 
-def HGNN_TNRMTL(traindata, trainlabel, train_task_interval, dim, num_class, num_task, hidden_dim, batch_size, method, reg_para, max_epoch, testdata, testlabel, test_task_interval, activate_op):
+def HGNN_TNRMTL(traindata, trainlabel, train_task_interval, dim, num_class, num_task, hidden_dim, batch_size, method, reg_para, max_epoch, testdata, testlabel, test_task_interval, activate_op, split_index=None, checkpoint=None):
     print('HGNN_TNRMTL with ' + method + ' trace norm regularization is running...')
-    inputs = tf.placeholder(tf.float32, shape=[None, dim], name='input')
-    inputs_data_label = tf.placeholder(tf.float32, shape=[None, num_class], name='label')
-    inputs_task_ind = tf.placeholder(tf.int32, shape=[1, None], name='inputs_task_ind')
-    inputs_num_ins_per_task = tf.placeholder(tf.int32, shape=[1, None], name='inputs_num_ins_per_task')
+    max_iter_epoch = numpy.ceil(traindata.shape[0] / (batch_size * num_task * num_class)).astype(np.int32)
+    Iterator = MTDataset(traindata, trainlabel, train_task_interval, num_class, batch_size, seed)
+    num_ins_per_task = np.ones([1, num_task], dtype=np.int32) * (batch_size * num_class)
+    if use_tf_data:
+        tf_batches = TFDataBatches(Iterator)
+        inputs = tf.placeholder_with_default(tf_batches.data, shape=[None, dim], name='input')
+    else:
+        inputs = tf.placeholder(tf.float32, shape=[None, dim], name='input')
+    inputs_data_label = tf.placeholder_with_default(Iterator.sampled_label, shape=[None, num_class], name='label')
+    inputs_task_ind = tf.placeholder_with_default(Iterator.sampled_task_ind, shape=[1, None], name='inputs_task_ind')
+    inputs_num_ins_per_task = tf.placeholder_with_default(num_ins_per_task, shape=[1, None], name='inputs_num_ins_per_task')
 
     input_hidden_weights = tf.Variable(tf.truncated_normal([dim, hidden_dim], dtype=tf.float32, stddev=1e-1),
                                        name='input_hidden_weights')
 
     hidden_features = activate_function(tf.matmul(inputs, input_hidden_weights), activate_op)
 
-    adjacency_matrix = compute_adjacency_matrix(hidden_features, inputs_data_label, num_task)
+    if top_k_neighbours:
+        if block_sign_matrix:
+            sign_matrix = get_block_node_class(num_task, num_class, batch_size)
+        else:
+            sign_matrix = compute_node_class(inputs_data_label, num_task)
+    elif block_sign_matrix:
+        sign_matrix = get_block_sign_matrix(num_class, batch_size)
+    else:
+        sign_matrix = compute_sign_matrix(inputs_data_label, num_task)
+    adjacency_matrix = compute_adjacency_matrix(hidden_features, sign_matrix, num_task)
 
     first_task_att_w = tf.Variable(tf.truncated_normal(
         [hidden_dim, GAT_hidden_dim], dtype=tf.float32, stddev=1e-1))
@@ -438,52 +554,111 @@ def HGNN_TNRMTL(traindata, trainlabel, train_task_interval, dim, num_class, num_
     class_attention_weight = tf.Variable(tf.truncated_normal(
         [GAT_hidden_dim, F_pie_c], dtype=tf.float32, stddev=1e-1), name='class_attention_weight')
 
-    feature_representation = get_feature_representation(inputs, input_hidden_weights, hidden_features, adjacency_matrix,
-                                               num_task, num_class, activate_op, first_task_att_w, first_class_att_w, task_attention_weight, class_attention_weight, inputs_data_label)
+    feature_parts = get_feature_representation(inputs, input_hidden_weights, hidden_features, adjacency_matrix,
+                                               num_task, num_class, activate_op, first_task_att_w, first_class_att_w, task_attention_weight, class_attention_weight, sign_matrix)
 
     hidden_output_weight = tf.Variable(tf.truncated_normal(
         [num_task, hidden_dim + F_pie_t + F_pie_c, num_class], dtype=tf.float32, stddev=1e-1), name='hidden_output_weight')
 
-    train_loss = tf.Variable(0.0, dtype=tf.float32, name='train_loss')
-    _, _, _, _, _, _, train_loss = tf.while_loop(
-        cond=lambda i, j1, j2, j3, j4, j5, j6: tf.less(i, tf.shape(inputs_task_ind)[1]), body=compute_train_loss,
-        loop_vars=(tf.constant(0, dtype=tf.int32), feature_representation, hidden_output_weight,
-                   inputs_data_label, inputs_task_ind, inputs_num_ins_per_task, train_loss))
+    logits = compute_logits(feature_parts, hidden_output_weight, num_task, num_class)
+    train_loss = compute_train_loss(logits, inputs_data_label, inputs_num_ins_per_task)
 
     obj = train_loss + reg_para * (TensorTraceNorm(hidden_output_weight, method) + tf.square(tf.norm(input_hidden_weights)))
 
-    learning_rate = tf.placeholder(tf.float32)
-    gradient_clipping_threshold = tf.placeholder(tf.float32)
+    global_step = tf.Variable(0, dtype=tf.int32, trainable=False, name='global_step')
+    learning_rate = tf.placeholder_with_default(0.02 / (1 + tf.cast(global_step // max_iter_epoch, tf.float32)), shape=[])
+    gradient_clipping_threshold = tf.placeholder_with_default(5., shape=[])
     optimizer = tf.train.AdamOptimizer(learning_rate)
-    gradient_clipping_option = tf.placeholder(tf.int32)
+    gradient_clipping_option = tf.placeholder_with_default(0, shape=[])
     train_step = gradient_clipping_tf(optimizer, obj, gradient_clipping_option, gradient_clipping_threshold)
+    with tf.control_dependencies([train_step]):
+        train_step = tf.group(tf.assign_add(global_step, 1))
     init_op = tf.global_variables_initializer()
     with tf.Session() as sess:
-        max_iter_epoch = numpy.ceil(traindata.shape[0] / (batch_size * num_task * num_class)).astype(
-            np.int32)
-        Iterator = MTDataset(traindata, trainlabel, train_task_interval, num_class, batch_size)
         sess.run(init_op)
-
-        train_label_matrix, train_task_ind = generate_label_task_ind(trainlabel, train_task_interval, num_class)
-        for iter in range(max_iter_epoch * max_epoch):
-            sampled_data, sampled_label, sampled_task_ind, _ = Iterator.get_next_batch()
-            num_iter = iter // max_iter_epoch
-            train_step.run(feed_dict={d1: d2 for d1, d2 in
-                                      zip([learning_rate, gradient_clipping_option, gradient_clipping_threshold, inputs,
-                                           inputs_data_label, inputs_task_ind, inputs_num_ins_per_task],
-                                          [0.02 / (1 + num_iter), 0, 5., sampled_data, sampled_label, sampled_task_ind,
-                                           np.ones([1, num_task]) * (batch_size * num_class)])})
-            if iter % max_iter_epoch == 0 and num_iter % 5 == 0:
-                train_hidden_features = hidden_features.eval(feed_dict={inputs: traindata, inputs_task_ind: train_task_ind})
-                task_embedding_vectors, class_embedding_vectors = get_embedding_vec(traindata, input_hidden_weights.eval(), first_task_att_w.eval(), first_class_att_w.eval(), task_attention_weight.eval(), class_attention_weight.eval(),
-                                    train_hidden_features, train_label_matrix, train_task_ind, np.reshape(
-                                   train_task_interval[0, 1:] - train_task_interval[0, 0:num_task], [1, -1]), num_task, num_class)
-                _, test_task_ind = generate_label_task_ind(testlabel, test_task_interval, num_class)
-                test_hidden_rep = hidden_features.eval(feed_dict={inputs: testdata, inputs_task_ind: test_task_ind})
-                new_test_hidden_rep = get_new_hidden_features(test_hidden_rep, task_embedding_vectors, class_embedding_vectors, hidden_output_weight.eval(), test_task_ind, num_task, num_class)
-                test_errors = compute_errors(new_test_hidden_rep, hidden_output_weight.eval(), test_task_ind, testlabel,
+        start_iter = 0 if checkpoint is None else restore_checkpoint(sess, checkpoint, Iterator)
+        checkpointer = AsyncCheckpointer(checkpoint_path) if checkpoint_path is not None else None
+        if use_tf_data:
+            tf_batches.initialize(sess)
+        elif num_prefetch > 0:
+            Iterator = BatchPrefetcher(Iterator, num_prefetch, record_state=checkpointer is not None)
+
+        _, train_task_ind = generate_label_task_ind(trainlabel, train_task_interval, num_class)
+        _, test_task_ind = generate_label_task_ind(testlabel, test_task_interval, num_class)
+        train_groups = TaskClassGrouping(train_task_ind, num_task, trainlabel, num_class)
+        eval_pool = EmbeddingPool(eval_num_workers, train_groups, num_class, eval_tile_size, top_k_neighbours) if eval_num_workers > 0 else None
+        # the worker processes and shared blocks are released even when training or an evaluation fails
+        try:
+            def embed(weights):
+                # final task (and class) embeddings of a snapshot of the trainable variables
+                train_hidden_features = sess.run(hidden_features, feed_dict={**weights, inputs: traindata, inputs_task_ind: train_task_ind})
+                task_embedding_vectors, class_embedding_vectors = get_embedding_vec(traindata, weights[input_hidden_weights], weights[first_task_att_w], weights[first_class_att_w], weights[task_attention_weight], weights[class_attention_weight],
+                                    train_hidden_features, train_groups, num_task, num_class, eval_pool)
+                check_no_upcast(strict_float32, train_hidden_features=train_hidden_features,
+                                task_embedding_vectors=task_embedding_vectors,
+                                class_embedding_vectors=class_embedding_vectors)
+                return task_embedding_vectors, class_embedding_vectors
+
+            def evaluate(epoch, weights):
+                # runs on a snapshot of the trainable variables, fed in place of the live ones, so it gives the same
+                # result on the training thread or on the evaluator's
+                task_embedding_vectors, class_embedding_vectors = embed(weights)
+                test_hidden_rep = sess.run(hidden_features, feed_dict={**weights, inputs: testdata, inputs_task_ind: test_task_ind})
+                new_test_hidden_rep = get_new_hidden_features(test_hidden_rep, task_embedding_vectors, class_embedding_vectors, weights[hidden_output_weight], test_task_ind, num_task, num_class)
+                check_no_upcast(strict_float32, new_test_hidden_rep=new_test_hidden_rep)
+                test_errors = compute_errors(new_test_hidden_rep, weights[hidden_output_weight], test_task_ind, testlabel,
                                                  num_task)
-                print('epoch = %g, test_errors = %s' % (num_iter, test_errors))
+                print('epoch = %g, test_errors = %s' % (epoch, test_errors))
+                return test_errors
+
+            eval_variables = tf.trainable_variables()
+            last_eval = None if checkpoint is None else restore_last_eval(checkpoint, eval_variables)
+            test_errors = None
+            evaluator = AsyncEvaluator(evaluate, max_pending_evals) if async_eval else None
+            train_time = 0.
+            for iter in range(start_iter, max_iter_epoch * max_epoch):
+                num_iter = iter // max_iter_epoch
+                start_time = time.time()
+                if use_tf_data:
+                    train_step.run()
+                else:
+                    sampled_data, sampled_label, sampled_task_ind, _ = Iterator.get_next_batch()
+                    check_no_upcast(strict_float32, sampled_data=sampled_data, sampled_label=sampled_label)
+                    train_step.run(feed_dict={inputs: sampled_data})
+                train_time += time.time() - start_time
+                if checkpointer is not None and (iter + 1) % (max_iter_epoch * checkpoint_every) == 0:
+                    checkpointer.save(snapshot_checkpoint(sess, iter + 1, Iterator, split_index, last_eval))
+                if iter % max_iter_epoch == 0 and num_iter % eval_every == 0:
+                    weights = dict(zip(eval_variables, sess.run(eval_variables)))
+                    last_eval = (num_iter, weights)
+                    if evaluator is None:
+                        test_errors = evaluate(num_iter, weights)
+                    else:
+                        evaluator.submit(num_iter, weights)
+            if evaluator is not None:
+                test_errors = evaluator.close()
+                print('async eval stats: %s' % evaluator.get_stats())
+            if test_errors is None and last_eval is not None:
+                # a resumed run that ended before its next evaluation reports the latest one of the run it continues
+                test_errors = evaluate(*last_eval)
+            if checkpointer is not None:
+                checkpointer.close()
+            if export_path is not None:
+                weights = dict(zip(eval_variables, sess.run(eval_variables)))
+                task_embedding_vectors, class_embedding_vectors = embed(weights)
+                export_model(export_path, {'input_hidden_weights': weights[input_hidden_weights],
+                                           'hidden_output_weight': sess.run(hidden_output_weight, feed_dict=weights),
+                                           'task_embedding_vectors': np.stack(task_embedding_vectors),
+                                           'class_embedding_vectors': class_embedding_vectors},
+                             {'model': 'HGNN_TNRMTL', 'kind': 'classification', 'activate_op': int(activate_op),
+                              'num_class': int(num_class)})
+            print('mean step time = %.2f ms' % (1000 * train_time / max(max_iter_epoch * max_epoch - start_iter, 1)))
+            if isinstance(Iterator, BatchPrefetcher):
+                print('prefetch stats: %s' % Iterator.get_stats())
+                Iterator.close()
+        finally:
+            if eval_pool is not None:
+                eval_pool.close()
     return test_errors
 
 
@@ -492,12 +667,24 @@ def main_process(filename, train_size, hidden_dim, batch_size, reg_para, max_epo
         os.environ['CUDA_VISIBLE_DEVICES'] = gpu_id
     else:
         os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    if seed is not None:
+        np.random.seed(seed)
     data, label, task_interval, num_task, num_class = read_data_from_file(filename)
     data_split = MTDataset_Split(data, label, task_interval, num_class)
     dim = data.shape[1]
-    traindata, trainlabel, train_task_interval, testdata, testlabel, test_task_interval = data_split.split(train_size)
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is None:
+        split_index = data_split.split_index(train_size)
+    else:
+        print('resuming from %s' % checkpoint_path)
+        split_index = tuple(checkpoint['split'][key] for key in SPLIT_KEYS)
+    traindata, trainlabel, train_task_interval, testdata, testlabel, test_task_interval = data_split.take(*split_index)
+    traindata = traindata.astype(storage_dtype, copy=False)
+    testdata = testdata.astype(storage_dtype, copy=False)
+    check_no_upcast(strict_float32, traindata=traindata, trainlabel=trainlabel, testdata=testdata, testlabel=testlabel)
     error = HGNN_TNRMTL(traindata, trainlabel, train_task_interval, dim, num_class, num_task, hidden_dim,
-                        batch_size, 'Tucker', reg_para, max_epoch, testdata, testlabel, test_task_interval, activate_op)
+                        batch_size, 'Tucker', reg_para, max_epoch, testdata, testlabel, test_task_interval, activate_op,
+                        split_index, checkpoint)
     return error
 
 
@@ -510,10 +697,28 @@ batch_size = 32
 reg_para = 0.2
 train_size = 0.7
 activate_op = 1
+storage_dtype = np.float32
+strict_float32 = 0
+num_prefetch = 0
+use_tf_data = 0
+decompose_logits = 0
+eval_tile_size = 1024
+eval_num_workers = 0
+eval_every = 5
+async_eval = 0
+max_pending_evals = 2
+checkpoint_path = None
+checkpoint_every = 5
+export_path = None
+top_k_neighbours = 0
+adjacency_tile_size = 256
+block_sign_matrix = 1
+seed = None
 GAT_hidden_dim = 16
 F_pie_t = 8
 F_pie_c = 8
-mean_errors = main_process(datafile, train_size, hidden_dim, batch_size, reg_para, max_epoch, use_gpu, gpu_id,
-                           activate_op)
+if __name__ == '__main__':
+    mean_errors = main_process(datafile, train_size, hidden_dim, batch_size, reg_para, max_epoch, use_gpu, gpu_id,
+                               activate_op)
 
-print('final test_errors = ', mean_errors)
+    print('final test_errors = ', mean_errors)
@@ -0,0 +1,412 @@
+import numpy as np
+import sys
+import time
+
+
+def time_call(fn, num_runs):
+    fn()
+    start = time.time()
+    for _ in range(num_runs):
+        fn()
+    return (time.time() - start) / num_runs
+
+
+def make_synthetic_dataset(num_task=4, num_class=65, num_ins_per_class=40, dim=2048, seed=0):
+    # office_home sized: 4 tasks x 65 classes of 2048-d features
+    rng = np.random.RandomState(seed)
+    num_ins = num_task * num_class * num_ins_per_class
+    data = rng.randn(num_ins, dim).astype(np.float32)
+    label = np.reshape(np.tile(np.repeat(np.arange(num_class), num_ins_per_class), num_task), [1, -1])
+    task_interval = np.reshape(np.arange(num_task + 1) * num_class * num_ins_per_class, [1, -1])
+    return data, label, task_interval
+
+
+class LoopMTDataset:
+    # the per-bucket Python loop that MTDataset.get_next_batch used to run, kept as the baseline
+    def __init__(self, data, label, task_interval, num_class, batch_size):
+        self.data = data
+        self.data_dim = data.shape[1]
+        self.label = np.reshape(label, [1, -1])
+        self.task_interval = np.reshape(task_interval, [1, -1])
+        self.num_task = task_interval.size - 1
+        self.num_class = num_class
+        self.batch_size = batch_size
+        index_list = []
+        for i in range(self.num_task):
+            start = self.task_interval[0, i]
+            end = self.task_interval[0, i + 1]
+            for j in range(self.num_class):
+                index_list.append(np.arange(start, end)[np.where(self.label[0, start:end] == j)[0]])
+        self.index_list = index_list
+        self.counter = np.zeros([1, self.num_task * self.num_class], dtype=np.int32)
+
+    def get_next_batch(self):
+        sampled_data = np.zeros([self.batch_size * self.num_class * self.num_task, self.data_dim], dtype=np.float32)
+        sampled_label = np.zeros([self.batch_size * self.num_class * self.num_task, self.num_class], dtype=np.int32)
+        sampled_task_ind = np.zeros([1, self.batch_size * self.num_class * self.num_task], dtype=np.int32)
+        sampled_label_ind = np.zeros([1, self.batch_size * self.num_class * self.num_task], dtype=np.int32)
+        for i in range(self.num_task):
+            for j in range(self.num_class):
+                cur_ind = i * self.num_class + j
+                task_class_index = self.index_list[cur_ind]
+                sampled_ind = range(cur_ind * self.batch_size, (cur_ind + 1) * self.batch_size)
+                sampled_task_ind[0, sampled_ind] = i
+                sampled_label_ind[0, sampled_ind] = j
+                sampled_label[sampled_ind, j] = 1
+                if task_class_index.size < self.batch_size:
+                    sampled_data[sampled_ind, :] = self.data[np.concatenate((task_class_index, task_class_index[
+                        np.random.randint(0, high=task_class_index.size, size=self.batch_size - task_class_index.size)])), :]
+                elif self.counter[0, cur_ind] + self.batch_size < task_class_index.size:
+                    sampled_data[sampled_ind, :] = self.data[task_class_index[self.counter[0, cur_ind]:self.counter[0, cur_ind] + self.batch_size], :]
+                    self.counter[0, cur_ind] = self.counter[0, cur_ind] + self.batch_size
+                else:
+                    sampled_data[sampled_ind, :] = self.data[task_class_index[-self.batch_size:], :]
+                    self.counter[0, cur_ind] = 0
+                    np.random.shuffle(self.index_list[cur_ind])
+        return sampled_data, sampled_label, sampled_task_ind, sampled_label_ind
+
+
+def load_script_class(filename, name, namespace):
+    # the model scripts import TensorFlow at module level; this compiles just one class definition of a script
+    # into namespace, for benchmarks of NumPy-only code that must run without TensorFlow installed
+    import ast
+    import os
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    with open(path, 'r') as file:
+        tree = ast.parse(file.read(), path)
+    node = next(node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == name)
+    exec(compile(ast.Module(body=[node], type_ignores=[]), path, 'exec'), namespace)
+    return namespace[name]
+
+
+def benchmark_batcher(num_batches=100, batch_size=32):
+    # get_state / set_state would need checkpoint.py, which imports TensorFlow; sampling only needs NumPy
+    MTDataset = load_script_class('DMTL_HGNN.py', 'MTDataset', {'np': np})
+    data, label, task_interval = make_synthetic_dataset()
+    num_class = label.max() + 1
+    print('batcher: %d tasks x %d classes x %d rows per class, dim %d' % (
+        task_interval.size - 1, num_class, batch_size, data.shape[1]))
+    for name, dataset in [('loop', LoopMTDataset(data, label, task_interval, num_class, batch_size)),
+                          ('vectorized', MTDataset(data, label, task_interval, num_class, batch_size))]:
+        seconds = time_call(dataset.get_next_batch, num_batches)
+        print('  %-12s %8.1f batches/s' % (name, 1 / seconds))
+
+
+def legacy_train_loss(feature_representation, hidden_output_weight, inputs_data_label, inputs_task_ind,
+                      inputs_num_ins_per_task, rows_per_task):
+    # the per-instance tf.while_loop the classification scripts used to build, kept as the baseline
+    import tensorflow as tf
+
+    def body(i, train_loss):
+        train_loss += tf.div(tf.losses.softmax_cross_entropy(
+            tf.expand_dims(inputs_data_label[i, :], 0),
+            tf.matmul(tf.expand_dims(feature_representation[inputs_task_ind[0, i]][i % rows_per_task][:], 0),
+                      hidden_output_weight[inputs_task_ind[0, i], :, :])),
+            tf.cast(inputs_num_ins_per_task[0, inputs_task_ind[0, i]], dtype=tf.float32))
+        return i + 1, train_loss
+    _, train_loss = tf.while_loop(cond=lambda i, train_loss: tf.less(i, tf.shape(inputs_task_ind)[1]), body=body,
+                                  loop_vars=(tf.constant(0, dtype=tf.int32), tf.constant(0.0, dtype=tf.float32)))
+    return train_loss
+
+
+def benchmark_loss(num_steps=20, num_task=4, num_class=65, batch_size=8, feature_dim=1024):
+    import tensorflow as tf
+    from DMTL_HGNN import compute_train_loss
+    rows_per_task = num_class * batch_size
+    num_ins = num_task * rows_per_task
+    rng = np.random.RandomState(0)
+    label = np.tile(np.repeat(np.arange(num_class), batch_size), num_task)
+    print('loss: %d tasks x %d rows per task, feature dim %d' % (num_task, rows_per_task, feature_dim))
+    with tf.Graph().as_default():
+        feature_representation = tf.Variable(rng.randn(num_task, rows_per_task, feature_dim).astype(np.float32))
+        hidden_output_weight = tf.Variable(rng.randn(num_task, feature_dim, num_class).astype(np.float32) * 1e-2)
+        inputs_data_label = tf.constant(np.eye(num_class, dtype=np.float32)[label])
+        inputs_task_ind = tf.constant(np.reshape(np.repeat(np.arange(num_task), rows_per_task), [1, -1]), dtype=tf.int32)
+        inputs_num_ins_per_task = tf.constant(np.full([1, num_task], num_ins // num_task), dtype=tf.int32)
+        losses = [('while_loop', legacy_train_loss(feature_representation, hidden_output_weight, inputs_data_label,
+                                                   inputs_task_ind, inputs_num_ins_per_task, rows_per_task)),
+                  ('batched', compute_train_loss(tf.matmul(feature_representation, hidden_output_weight),
+                                                 inputs_data_label, inputs_num_ins_per_task))]
+        optimizer = tf.train.GradientDescentOptimizer(1e-3)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            print('  max abs difference %g' % abs(sess.run(losses[0][1]) - sess.run(losses[1][1])))
+            for name, loss in losses:
+                train_step = optimizer.minimize(loss)
+                seconds = time_call(lambda: sess.run(train_step), num_steps)
+                print('  %-12s %8.2f ms/step' % (name, seconds * 1e3))
+
+
+def legacy_adjacency_matrix(hidden_features, inputs_data_label, num_task):
+    # the per-task loop compute_adjacency_matrix used to build, kept as the reference
+    import tensorflow as tf
+    from DMTL_HGNN import change_datastruct, compute_pairwise_dist_tf
+    new_hidden_features = change_datastruct(hidden_features, num_task)
+    new_inputs_data_label = change_datastruct(inputs_data_label, num_task)
+    adjacency_matrixs = []
+    for i in range(num_task):
+        dist_matrix = -compute_pairwise_dist_tf(new_hidden_features[i])
+        sign_matrix = 2 * tf.matmul(new_inputs_data_label[i], tf.matrix_transpose(new_inputs_data_label[i])) - 1
+        adjacency_matrixs.append(tf.exp(dist_matrix) * sign_matrix)
+    return tf.stack(adjacency_matrixs)
+
+
+def benchmark_adjacency(num_runs=20, num_task=4, num_class=65, batch_size=4, hidden_dim=600):
+    import tensorflow as tf
+    from DMTL_HGNN import compute_adjacency_matrix, compute_sign_matrix, get_block_sign_matrix
+    num_ins = num_task * num_class * batch_size
+    rng = np.random.RandomState(0)
+    # small features keep exp(-dist) away from underflow so the comparison is meaningful
+    features = rng.randn(num_ins, hidden_dim).astype(np.float32) * 0.02
+    label = np.eye(num_class, dtype=np.float32)[np.tile(np.repeat(np.arange(num_class), batch_size), num_task)]
+    print('adjacency: %d tasks x %d rows per task, hidden dim %d' % (num_task, num_ins // num_task, hidden_dim))
+    builds = [('per_task', legacy_adjacency_matrix),
+              ('batched', lambda hidden_features, inputs_data_label, num_task: compute_adjacency_matrix(
+                  hidden_features, compute_sign_matrix(inputs_data_label, num_task), num_task)),
+              ('block_sign', lambda hidden_features, inputs_data_label, num_task: compute_adjacency_matrix(
+                  hidden_features, get_block_sign_matrix(num_class, batch_size), num_task))]
+    for name, build in builds:
+        with tf.Graph().as_default() as graph:
+            # the same kinds of nodes the model graph has, so nothing but the block sign matrix is constant-folded
+            hidden_features = tf.Variable(features)
+            inputs_data_label = tf.placeholder_with_default(label, shape=[None, num_class])
+            num_ops = len(graph.get_operations())
+            adjacency_matrix = build(hidden_features, inputs_data_label, num_task)
+            num_ops = len(graph.get_operations()) - num_ops
+            with tf.Session() as sess:
+                sess.run(hidden_features.initializer)
+                value = sess.run(adjacency_matrix)
+                seconds = time_call(lambda: sess.run(adjacency_matrix.op), num_runs)
+        if name == 'per_task':
+            reference = value
+        print('  %-12s %6d ops %8.2f ms  max abs difference %g' % (
+            name, num_ops, seconds * 1e3, np.max(np.abs(value - reference))))
+        np.testing.assert_allclose(value, reference, rtol=1e-5, atol=1e-6)
+
+
+def legacy_augment_features(hidden_features, task_embedding_vectors, class_embedding_vectors, num_task, num_class,
+                            batch_size):
+    # the row-by-row stacking get_feature_representation used to build, kept as the baseline
+    import tensorflow as tf
+    feature_representations = []
+    for i in range(num_task):
+        feature_representation = []
+        feature_representation_1 = tf.concat([
+            hidden_features[i * batch_size * num_class: (i + 1) * batch_size * num_class],
+            tf.stack([task_embedding_vectors[i] for _ in range(num_class * batch_size)])], 1)
+        for j in range(num_class):
+            feature_representation_2 = tf.concat([
+                feature_representation_1[j * batch_size: (j + 1) * batch_size],
+                tf.stack([class_embedding_vectors[i * num_task + j] for _ in range(batch_size)])], 1)
+            feature_representation.append(feature_representation_2)
+        feature_representations.append(feature_representation)
+    feature_representations = tf.stack(feature_representations)
+    return tf.reshape(feature_representations, [num_task, -1, feature_representations.shape[-1]])
+
+
+def benchmark_graph_build(num_task=4, num_class=65, batch_size=32, hidden_dim=600, embedding_dim=8):
+    import tensorflow as tf
+    from DMTL_HGNN import augment_features
+    num_ins = num_task * num_class * batch_size
+    rng = np.random.RandomState(0)
+    features = rng.randn(num_ins, hidden_dim).astype(np.float32)
+    task_embedding = rng.randn(num_task, embedding_dim).astype(np.float32)
+    class_embedding = rng.randn(num_task * num_class, embedding_dim).astype(np.float32)
+    print('graph build: %d tasks x %d classes x %d rows per class, hidden dim %d' % (
+        num_task, num_class, batch_size, hidden_dim))
+    builds = [('stacked', lambda *args: legacy_augment_features(*args, batch_size=batch_size)),
+              ('tiled', augment_features)]
+    for name, build in builds:
+        with tf.Graph().as_default() as graph:
+            hidden_features = tf.placeholder_with_default(features, shape=[None, hidden_dim])
+            task_embedding_vectors = tf.Variable(task_embedding)
+            class_embedding_vectors = tf.Variable(class_embedding)
+            num_ops = len(graph.get_operations())
+            start = time.time()
+            feature_representation = build(hidden_features, task_embedding_vectors, class_embedding_vectors,
+                                            num_task, num_class)
+            build_time = time.time() - start
+            num_ops = len(graph.get_operations()) - num_ops
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                value = sess.run(feature_representation)
+        if name == 'stacked':
+            reference = value
+        print('  %-12s %6d ops %8.2f s to build  max abs difference %g' % (
+            name, num_ops, build_time, np.max(np.abs(value - reference))))
+
+
+def benchmark_eval_workers(max_workers=None, num_runs=3, num_task=4, num_class=65, num_ins_per_class=40, hidden_dim=600,
+                           tile_size=256):
+    import os
+    from hgnn_np import TaskClassGrouping, EmbeddingPool, task_graph_embeddings
+    rng = np.random.RandomState(0)
+    task_ind = np.repeat(np.arange(num_task), num_class * num_ins_per_class)
+    class_id = np.tile(np.repeat(np.arange(num_class), num_ins_per_class), num_task)
+    input_hidden = rng.randn(task_ind.size, hidden_dim).astype(np.float32)
+    hidden_features = (0.1 * rng.randn(task_ind.size, hidden_dim)).astype(np.float32)
+    grouping = TaskClassGrouping(task_ind, num_task, class_id, num_class)
+    print('eval workers: %d tasks x %d classes x %d rows per class, hidden dim %d' % (
+        num_task, num_class, num_ins_per_class, hidden_dim))
+    reference = task_graph_embeddings(input_hidden, hidden_features, grouping, num_class, tile_size)
+    serial_time = time_call(lambda: task_graph_embeddings(input_hidden, hidden_features, grouping, num_class,
+                                                          tile_size), num_runs)
+    print('  %-12s %8.2f s' % ('serial', serial_time))
+    for num_workers in range(1, (max_workers or os.cpu_count()) + 1):
+        pool = EmbeddingPool(num_workers, grouping, num_class, tile_size)
+        try:
+            seconds = time_call(lambda: task_graph_embeddings(input_hidden, hidden_features, grouping, num_class,
+                                                              tile_size, pool), num_runs)
+            value = task_graph_embeddings(input_hidden, hidden_features, grouping, num_class, tile_size, pool)
+        finally:
+            pool.close()
+        error = max(np.max(np.abs(np.stack(value[0]) - np.stack(reference[0]))),
+                    np.max(np.abs(value[1] - reference[1])))
+        print('  %-12s %8.2f s  %5.2fx  max abs difference %g' % (
+            '%d workers' % num_workers, seconds, serial_time / seconds, error))
+
+
+def make_exported_model(path, num_task, num_class, dim, hidden_dim, embedding_dim, seed=0):
+    from model_export import export_model
+    rng = np.random.RandomState(seed)
+    export_model(path, {'input_hidden_weights': (rng.randn(dim, hidden_dim) / np.sqrt(dim)).astype(np.float32),
+                        'hidden_output_weight': rng.randn(num_task, hidden_dim + 2 * embedding_dim,
+                                                          num_class).astype(np.float32),
+                        'task_embedding_vectors': rng.randn(num_task, embedding_dim).astype(np.float32),
+                        'class_embedding_vectors': rng.randn(num_task * num_class, embedding_dim).astype(np.float32)},
+                 {'model': 'synthetic', 'kind': 'classification', 'activate_op': 1, 'num_class': num_class})
+
+
+def time_startup(code):
+    import os
+    import subprocess
+    start = time.time()
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - start if result.returncode == 0 else None
+
+
+def benchmark_predictor(num_requests=200, batch_sizes=(1, 32, 256), num_task=4, num_class=65, dim=2048,
+                        hidden_dim=600, embedding_dim=8):
+    import os
+    import tempfile
+    from predictor import NumpyPredictor
+    path = os.path.join(tempfile.mkdtemp(), 'model.hgnn')
+    make_exported_model(path, num_task, num_class, dim, hidden_dim, embedding_dim)
+    print('predictor: %d tasks x %d classes, dim %d, hidden dim %d' % (num_task, num_class, dim, hidden_dim))
+    # start-up is measured in a fresh interpreter, up to the first scored sample
+    numpy_startup = time_startup('import numpy as np\n'
+                                 'from predictor import NumpyPredictor\n'
+                                 'NumpyPredictor(%r).predict(np.zeros([1, %d], np.float32), 0)\n' % (path, dim))
+    tf_startup = time_startup('import numpy as np\n'
+                              'import tensorflow as tf\n'
+                              'from model_export import load_model\n'
+                              'arrays, meta = load_model(%r)\n'
+                              'inputs = tf.placeholder(tf.float32, shape=[None, %d])\n'
+                              'hidden = tf.tanh(tf.matmul(inputs, arrays["input_hidden_weights"]))\n'
+                              'tf.Session().run(hidden, feed_dict={inputs: np.zeros([1, %d], np.float32)})\n'
+                              % (path, dim, dim))
+    print('  start-up     numpy %6.2f s   tensorflow %s' % (
+        numpy_startup, 'unavailable' if tf_startup is None else '%6.2f s' % tf_startup))
+    predictor = NumpyPredictor(path)
+    predictors = [('numpy', predictor.predict)]
+    try:
+        import tensorflow as tf
+        from DMTL_HGNN import get_new_hidden_features
+        from model_export import load_model
+        arrays, _ = load_model(path)
+        inputs = tf.placeholder(tf.float32, shape=[None, dim])
+        hidden_features = tf.tanh(tf.matmul(inputs, arrays['input_hidden_weights']))
+        sess = tf.Session()
+
+        def tf_predict(data, task_ind):
+            # the scripts' evaluation path: hidden features from the graph, then get_new_hidden_features and the
+            # per-task argmax of compute_errors
+            new_hidden_rep = get_new_hidden_features(sess.run(hidden_features, feed_dict={inputs: data}),
+                                                     arrays['task_embedding_vectors'],
+                                                     arrays['class_embedding_vectors'],
+                                                     arrays['hidden_output_weight'], task_ind[None], num_task,
+                                                     num_class)
+            prediction = np.zeros(task_ind.size, dtype=np.int64)
+            for i in range(num_task):
+                rows = np.flatnonzero(task_ind == i)
+                prediction[rows] = np.argmax(np.matmul(new_hidden_rep[rows], arrays['hidden_output_weight'][i]), 1)
+            return prediction
+
+        predictors.append(('tensorflow', tf_predict))
+    except ImportError:
+        pass
+    rng = np.random.RandomState(1)
+    for batch_size in batch_sizes:
+        requests = [(rng.randn(batch_size, dim).astype(np.float32), rng.randint(0, num_task, batch_size))
+                    for _ in range(num_requests)]
+        for name, predict in predictors:
+            latency = []
+            agree = 0
+            for data, task_ind in requests:
+                start = time.time()
+                prediction = predict(data, task_ind)
+                latency.append(time.time() - start)
+                agree += np.sum(prediction == predictor.predict(data, task_ind))
+            print('  batch %-6d %-10s p50 %7.3f ms  p99 %7.3f ms  agreement %.4f' % (
+                batch_size, name, 1000 * np.percentile(latency, 50), 1000 * np.percentile(latency, 99),
+                agree / (num_requests * batch_size)))
+
+
+def benchmark_server(num_clients=16, requests_per_client=50, configs=((1, 0.), (64, 0.002)), num_task=4,
+                     num_class=65, dim=2048, hidden_dim=600, embedding_dim=8):
+    import http.client
+    import json
+    import os
+    import tempfile
+    import threading
+    from predictor import NumpyPredictor
+    from serve import MicroBatcher, make_server
+    path = os.path.join(tempfile.mkdtemp(), 'model.hgnn')
+    make_exported_model(path, num_task, num_class, dim, hidden_dim, embedding_dim)
+    predictor = NumpyPredictor(path)
+    rng = np.random.RandomState(1)
+    bodies = [json.dumps({'data': rng.randn(1, dim).astype(np.float32).tolist(), 'task': int(rng.randint(num_task))})
+              for _ in range(requests_per_client)]
+    print('server: %d concurrent clients x %d single-row requests over localhost HTTP' % (
+        num_clients, requests_per_client))
+
+    def client(port):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        for body in bodies:
+            connection.request('POST', '/predict', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            assert response.status == 200
+        connection.close()
+
+    for max_batch_size, max_wait in configs:
+        batcher = MicroBatcher(predictor, max_batch_size, max_wait)
+        server = make_server(batcher)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        clients = [threading.Thread(target=client, args=(server.server_address[1],)) for _ in range(num_clients)]
+        start = time.time()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.time() - start
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+        stats = batcher.get_stats()
+        print('  max batch %-4d max wait %4.1f ms  %7.1f requests/s  latency p50 %.2f ms  p99 %.2f ms' % (
+            max_batch_size, 1000 * max_wait, stats['requests'] / elapsed, stats['latency_ms']['p50'],
+            stats['latency_ms']['p99']))
+        print('    batch sizes %s' % stats['batch_size_histogram'])
+
+
+BENCHMARKS = {'batcher': benchmark_batcher, 'loss': benchmark_loss, 'adjacency': benchmark_adjacency,
+              'graph_build': benchmark_graph_build, 'eval_workers': benchmark_eval_workers,
+              'predictor': benchmark_predictor, 'server': benchmark_server}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
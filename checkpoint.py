@@ -0,0 +1,116 @@
+import numpy as np
+import tensorflow as tf
+import os
+import queue
+import threading
+
+
+SPLIT_KEYS = ('train_index', 'train_task_interval', 'test_index', 'test_task_interval')
+
+
+def get_rng_state(rng):
+    # rng is either np.random itself or a RandomState; both expose the same legacy state tuple
+    _, key, pos, has_gauss, cached_gaussian = rng.get_state()
+    return {'rng_key': key, 'rng_pos': np.array(pos), 'rng_has_gauss': np.array(has_gauss),
+            'rng_cached_gaussian': np.array(cached_gaussian)}
+
+
+def set_rng_state(rng, state):
+    rng.set_state(('MT19937', state['rng_key'], int(state['rng_pos']), int(state['rng_has_gauss']),
+                   float(state['rng_cached_gaussian'])))
+
+
+def save_checkpoint(path, groups):
+    # one .npz with a '<group>/<name>' entry per array, written next to the target and renamed into place so a run
+    # killed mid-write leaves the previous checkpoint intact
+    arrays = {}
+    for group, values in groups.items():
+        for name, value in values.items():
+            arrays[group + '/' + name] = value
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    if path is None or not os.path.isfile(path):
+        return None
+    groups = {}
+    with np.load(path) as file:
+        for key in file.files:
+            group, name = key.split('/', 1)
+            groups.setdefault(group, {})[name] = file[key]
+    return groups
+
+
+def snapshot_checkpoint(sess, next_iter, dataset, split_index, last_eval=None):
+    # everything an uninterrupted run would carry over from step next_iter - 1 to step next_iter: every global
+    # variable (weights, Adam slots and power accumulators, global_step), the sampler cursors and both RNG states
+    variables = tf.global_variables()
+    groups = {'variables': dict(zip([var.op.name for var in variables], sess.run(variables))),
+              'dataset': dataset.get_state(),
+              'numpy_rng': get_rng_state(np.random),
+              'split': dict(zip(SPLIT_KEYS, split_index)),
+              'progress': {'iter': np.array(next_iter)}}
+    if last_eval is not None:
+        # the (epoch, weights) of the latest evaluation, so a resumed run that ends before its next evaluation can
+        # still report the result the uninterrupted run would have returned
+        epoch, weights = last_eval
+        groups['last_eval'] = {var.op.name: value for var, value in weights.items()}
+        groups['progress']['last_eval_epoch'] = np.array(epoch)
+    return groups
+
+
+def restore_checkpoint(sess, checkpoint, dataset):
+    for var in tf.global_variables():
+        var.load(checkpoint['variables'][var.op.name], sess)
+    set_rng_state(np.random, checkpoint['numpy_rng'])
+    # after the global state: with seed = None the sampler draws from np.random, and its recorded state wins
+    dataset.set_state(checkpoint['dataset'])
+    return int(checkpoint['progress']['iter'])
+
+
+def restore_last_eval(checkpoint, variables):
+    if 'last_eval' not in checkpoint:
+        return None
+    weights = checkpoint['last_eval']
+    return int(checkpoint['progress']['last_eval_epoch']), {var: weights[var.op.name] for var in variables}
+
+
+class AsyncCheckpointer:
+    """Write checkpoint snapshots to path on a worker thread, so a training step only pays for taking the snapshot.
+
+    While a write is in progress, at most one more snapshot is queued; save() blocks beyond that.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.num_saved = 0
+        self.worker = threading.Thread(target=self.__write__, name='async-checkpointer', daemon=True)
+        self.worker.start()
+
+    def __write__(self):
+        while True:
+            groups = self.pending.get()
+            if groups is None:
+                return
+            if self.error is None:
+                try:
+                    save_checkpoint(self.path, groups)
+                    self.num_saved += 1
+                except Exception as error:
+                    self.error = error
+
+    def save(self, groups):
+        if self.error is not None:
+            raise self.error
+        self.pending.put(groups)
+
+    def close(self):
+        self.pending.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
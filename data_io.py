@@ -0,0 +1,210 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+CACHE_VERSION = 4
+CACHE_DIR = '.cache'
+
+
+def stream_parse_data_file(filename, regression=False, chunk_bytes=1 << 24, verbose=True):
+    start_time = time.time()
+    with open(filename, 'r') as file:
+        num_task = int(file.readline())
+        num_class = None if regression else int(file.readline())
+        task_interval = np.reshape(np.fromstring(file.readline(), dtype=np.int64, sep=','), [1, -1])
+        num_ins = int(task_interval[0, -1])
+        first_row = np.fromstring(file.readline(), dtype=np.float32, sep=',')
+        dim = first_row.size
+        # the header already tells how many rows follow, so the whole matrix is allocated once and filled block by
+        # block; only one chunk of raw text is alive at any time
+        data = np.empty([num_ins, dim], dtype=np.float32)
+        data[0] = first_row
+        pos = 1
+        rest = []
+        while pos < num_ins:
+            lines = file.readlines(chunk_bytes)
+            if not lines:
+                raise ValueError('%s: expected %d data rows, found %d' % (filename, num_ins, pos))
+            rest = lines[num_ins - pos:]
+            lines = lines[:num_ins - pos]
+            block = np.fromstring(''.join(lines).replace('\n', ','), dtype=np.float32, sep=',')
+            if block.size != len(lines) * dim:
+                raise ValueError('%s: malformed data rows %d-%d' % (filename, pos + 1, pos + len(lines)))
+            data[pos: pos + len(lines)] = np.reshape(block, [-1, dim])
+            pos += len(lines)
+        label_line = rest[0] if rest else file.readline()
+    label = np.fromstring(label_line, dtype=np.float32 if regression else np.int64, sep=',')
+    if label.size != num_ins:
+        raise ValueError('%s: expected %d labels, found %d' % (filename, num_ins, label.size))
+    label = np.reshape(label, [1, -1])
+    elapsed = max(time.time() - start_time, 1e-9)
+    if verbose:
+        print('parsed %d rows from %s in %.2fs (%.0f rows/s)' % (num_ins, filename, elapsed, num_ins / elapsed))
+    return data, label, task_interval, num_task, num_class
+
+
+def parse_data_file(filename):
+    return stream_parse_data_file(filename)
+
+
+def parse_regression_data_file(filename):
+    data, label, task_interval, num_task, _ = stream_parse_data_file(filename, regression=True)
+    return data, label, task_interval, num_task
+
+
+def hash_file(filename, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        block = file.read(block_size)
+        while block:
+            sha1.update(block)
+            block = file.read(block_size)
+    return sha1.hexdigest()
+
+
+def get_cache_path(filename, kind):
+    # one directory per source file, file kind and on-disk layout; which contents of the source it holds is
+    # recorded in its meta.json (see is_cache_current)
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    return os.path.join(dirname, CACHE_DIR, '%s.%s.v%d' % (basename, kind, CACHE_VERSION))
+
+
+def is_cache_current(cache_path, meta, filename):
+    # size and mtime unchanged: a hit without reading the source. Otherwise the source is hashed once, and a file
+    # that was only touched or copied keeps its cache, with the new mtime recorded so the next run is a plain hit
+    source = meta.get('source') or {}
+    stat = os.stat(filename)
+    if source.get('size') == stat.st_size and source.get('mtime_ns') == stat.st_mtime_ns:
+        return True
+    if source.get('size') != stat.st_size or source.get('sha1') != hash_file(filename):
+        return False
+    meta['source'] = dict(source, mtime_ns=stat.st_mtime_ns)
+    try:
+        write_meta(cache_path, meta)
+    except OSError:
+        pass
+    return True
+
+
+def write_meta(cache_path, meta):
+    tmp_file = os.path.join(cache_path, 'meta.json.tmp')
+    with open(tmp_file, 'w') as file:
+        json.dump(meta, file)
+    os.replace(tmp_file, os.path.join(cache_path, 'meta.json'))
+
+
+def save_dataset_cache(cache_path, data, label, task_interval, num_task, num_class=None, source=None):
+    parent = os.path.dirname(cache_path)
+    os.makedirs(parent, exist_ok=True)
+    # write into a private directory and rename it into place, so concurrent runs never see a partial cache
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        np.save(os.path.join(tmp_path, 'data.npy'), np.ascontiguousarray(data))
+        np.save(os.path.join(tmp_path, 'label.npy'), np.ascontiguousarray(label))
+        np.save(os.path.join(tmp_path, 'task_interval.npy'), np.ascontiguousarray(task_interval))
+        write_meta(tmp_path, {'version': CACHE_VERSION, 'num_task': int(num_task),
+                              'num_class': None if num_class is None else int(num_class), 'source': source})
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(cache_path):
+            raise
+
+
+def load_dataset_cache(cache_path, filename=None):
+    # None when there is no usable cache: missing or unreadable files, another CACHE_VERSION or, with filename, a
+    # cache of other contents of that source file
+    try:
+        with open(os.path.join(cache_path, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        if meta.get('version') != CACHE_VERSION:
+            return None
+        if filename is not None and not is_cache_current(cache_path, meta, filename):
+            return None
+        # memory-mapped read-only arrays share the page cache between every run on the machine
+        data = np.load(os.path.join(cache_path, 'data.npy'), mmap_mode='r')
+        label = np.load(os.path.join(cache_path, 'label.npy'), mmap_mode='r')
+        task_interval = np.load(os.path.join(cache_path, 'task_interval.npy'))
+    except (ValueError, OSError):
+        # a truncated or half-deleted cache is parsed again like a missing one
+        return None
+    return data, label, task_interval, meta['num_task'], meta['num_class']
+
+
+def parse_dataset(filename, regression=False):
+    # the five fields load_dataset_cache returns, num_class being None for regression files
+    if regression:
+        data, label, task_interval, num_task = parse_regression_data_file(filename)
+        return data, label, task_interval, num_task, None
+    return parse_data_file(filename)
+
+
+def write_dataset_cache(cache_path, dataset, source):
+    if os.path.isdir(cache_path):
+        # a directory that did not load (stale source, no meta.json, another CACHE_VERSION) gets rebuilt
+        shutil.rmtree(cache_path, ignore_errors=True)
+    save_dataset_cache(cache_path, *dataset, source=source)
+
+
+def parse_and_stamp(filename, regression=False):
+    # the stamp is taken before parsing, so a source edited while it is parsed is seen as changed on the next run
+    stat = os.stat(filename)
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': hash_file(filename)}
+    return parse_dataset(filename, regression), source
+
+
+def convert_data_file(filename, regression=False):
+    cache_path = get_cache_path(filename, 'reg' if regression else 'cls')
+    if load_dataset_cache(cache_path, filename) is None:
+        write_dataset_cache(cache_path, *parse_and_stamp(filename, regression))
+    return cache_path
+
+
+def read_cached_dataset(filename, regression=False):
+    cache_path = get_cache_path(filename, 'reg' if regression else 'cls')
+    dataset = load_dataset_cache(cache_path, filename)
+    if dataset is None:
+        dataset, source = parse_and_stamp(filename, regression)
+        try:
+            write_dataset_cache(cache_path, dataset, source)
+        except OSError as error:
+            # a read-only or full data directory only costs the cache, the parsed arrays are used as they are
+            print('not caching %s: %s' % (filename, error))
+    return dataset
+
+
+def read_data_from_file(filename, use_cache=True):
+    if not use_cache:
+        return parse_data_file(filename)
+    return read_cached_dataset(filename)
+
+
+def read_regression_data_from_file(filename, use_cache=True):
+    if not use_cache:
+        return parse_regression_data_file(filename)
+    data, label, task_interval, num_task, _ = read_cached_dataset(filename, regression=True)
+    return data, label, task_interval, num_task
+
+
+def check_no_upcast(enabled, **arrays):
+    # float32 is the widest float type on the data path; anything wider is an accidental promotion that TensorFlow
+    # would silently cast back on every feed
+    if not enabled:
+        return
+    for name, array in arrays.items():
+        dtype = np.asarray(array).dtype
+        if dtype.kind == 'f' and dtype.itemsize > 4:
+            raise TypeError('%s was upcast to %s' % (name, dtype))
+
+
+if __name__ == '__main__':
+    import sys
+    regression = '--regression' in sys.argv[1:]
+    for name in sys.argv[1:]:
+        if name != '--regression':
+            print('%s -> %s' % (name, convert_data_file(name, regression)))
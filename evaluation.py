@@ -0,0 +1,52 @@
+import queue
+import threading
+
+
+class AsyncEvaluator:
+    """Run evaluate(epoch, weights) on a worker thread, in submission order, so training does not wait for it.
+
+    At most max_pending submitted evaluations wait behind the running one; submit() blocks while the queue is full.
+    close() waits for every submitted evaluation and returns the result of the last one.
+    """
+
+    def __init__(self, evaluate, max_pending):
+        self.evaluate = evaluate
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.result = None
+        self.error = None
+        self.num_submitted = 0
+        self.num_blocked = 0
+        self.worker = threading.Thread(target=self.__consume__, name='async-evaluator', daemon=True)
+        self.worker.start()
+
+    def __consume__(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            # after a failure the remaining snapshots are only drained, so submit() never blocks forever
+            if self.error is None:
+                try:
+                    self.result = self.evaluate(*item)
+                except Exception as error:
+                    self.error = error
+
+    def submit(self, epoch, weights):
+        if self.error is not None:
+            raise self.error
+        if self.pending.full():
+            self.num_blocked += 1
+        self.pending.put((epoch, weights))
+        self.num_submitted += 1
+
+    def get_stats(self):
+        return {'max_pending': self.pending.maxsize,
+                'submitted': self.num_submitted,
+                'blocked': self.num_blocked}
+
+    def close(self):
+        self.pending.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
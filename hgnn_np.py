@@ -0,0 +1,327 @@
+import numpy as np
+import multiprocessing
+import sys
+from multiprocessing import shared_memory
+
+
+def iterate_tiles(num_rows, tile_size):
+    for start in range(0, num_rows, tile_size):
+        yield start, min(start + tile_size, num_rows)
+
+
+class TaskClassGrouping:
+    # Sorts the rows of a fixed matrix once by task, then class, and exposes each task as a contiguous slice, so the
+    # evaluation that runs every few epochs on the unchanged training set does no per-row regrouping
+    def __init__(self, task_ind, num_task, class_id=None, num_class=0):
+        task_ind = np.reshape(task_ind, [-1])
+        if class_id is None:
+            self.order = np.argsort(task_ind, kind='stable')
+        else:
+            class_id = np.reshape(class_id, [-1])
+            counts = np.bincount(task_ind * num_class + class_id, minlength=num_task * num_class)
+            if np.any(counts == 0):
+                raise ValueError('every task needs at least one training instance of every class')
+            self.order = np.lexsort((class_id, task_ind))
+        self.is_sorted = np.array_equal(self.order, np.arange(task_ind.size))
+        self.task_ind = task_ind[self.order]
+        self.class_id = None if class_id is None else class_id[self.order]
+        self.task_offsets = np.searchsorted(self.task_ind, np.arange(num_task + 1))
+
+    def gather(self, array):
+        return array if self.is_sorted else np.take(array, self.order, axis=0)
+
+    def task_rows(self, task):
+        return slice(self.task_offsets[task], self.task_offsets[task + 1])
+
+
+def nearest_neighbours(features, sq_norm, row_start, row_stop, num_neighbours, tile_size=1024):
+    # indices of the num_neighbours nearest rows of each of the rows row_start:row_stop, the row itself included, kept
+    # as a running top-k over column tiles. 2 <f_i, f_j> - ||f_j||^2 ranks the columns of a row like
+    # -||f_i - f_j||^2, as select_neighbours does in the training graph
+    best_score = np.empty([row_stop - row_start, 0], dtype=features.dtype)
+    best_index = np.empty([row_stop - row_start, 0], dtype=np.int64)
+    for col_start, col_stop in iterate_tiles(features.shape[0], tile_size):
+        score = np.concatenate([best_score, 2 * np.dot(features[row_start: row_stop], features[
+            col_start: col_stop].transpose()) - sq_norm[None, col_start: col_stop]], 1)
+        index = np.concatenate([best_index, np.broadcast_to(np.arange(col_start, col_stop),
+                                                            [row_stop - row_start, col_stop - col_start])], 1)
+        if score.shape[1] > num_neighbours:
+            keep = np.argpartition(-score, num_neighbours - 1, axis=1)[:, :num_neighbours]
+            score, index = np.take_along_axis(score, keep, 1), np.take_along_axis(index, keep, 1)
+        best_score, best_index = score, index
+    return best_index
+
+
+def adjacency_product_rows(features, values, row_start, row_stop, class_id=None, tile_size=1024,
+                           same_class_product=False, num_neighbours=0):
+    # Rows row_start:row_stop of A @ values, where the instance graph is A[i, j] = exp(-||f_i - f_j||^2) * s_ij and
+    # s_ij is 1 without class ids and +1 / -1 for same-class / different-class pairs with them. Only tile_size-wide
+    # blocks of A are ever built, so memory stays bounded for tasks with tens of thousands of rows. With
+    # same_class_product, the product with the same-class part of A (different-class pairs set to 0) is returned as
+    # well. With num_neighbours > 0, A only keeps the num_neighbours nearest rows of every row, like the training
+    # graph with top_k_neighbours
+    sq_norm = np.sum(features ** 2, axis=1)
+    product = np.zeros([row_stop - row_start, values.shape[1]], dtype=np.result_type(features, values))
+    class_product = np.zeros_like(product) if same_class_product else None
+    if num_neighbours:
+        neighbour_index = nearest_neighbours(features, sq_norm, row_start, row_stop, num_neighbours, tile_size)
+        for index in neighbour_index.transpose():
+            adjacency = np.exp(-np.sum((features[row_start: row_stop] - features[index]) ** 2, 1))
+            if class_id is not None:
+                same_class = class_id[row_start: row_stop] == class_id[index]
+                if same_class_product:
+                    class_product += (adjacency * same_class)[:, None] * values[index]
+                adjacency = np.where(same_class, adjacency, -adjacency)
+            product += adjacency[:, None] * values[index]
+        return (product, class_product) if same_class_product else product
+    for col_start, col_stop in iterate_tiles(features.shape[0], tile_size):
+        dist_matrix = sq_norm[row_start: row_stop, None] - 2 * np.dot(
+            features[row_start: row_stop], features[col_start: col_stop].transpose()) + sq_norm[None, col_start: col_stop]
+        adjacency_matrix = np.exp(-dist_matrix)
+        if class_id is not None:
+            same_class = class_id[row_start: row_stop, None] == class_id[None, col_start: col_stop]
+            if same_class_product:
+                class_product += np.dot(adjacency_matrix * same_class, values[col_start: col_stop])
+            adjacency_matrix = np.where(same_class, adjacency_matrix, -adjacency_matrix)
+        product += np.dot(adjacency_matrix, values[col_start: col_stop])
+    if same_class_product:
+        return product, class_product
+    return product
+
+
+def first_round_rows(input_hidden, features, row_start, row_stop, class_id=None, num_class=0, tile_size=1024,
+                     num_neighbours=0):
+    # first-round features of rows row_start:row_stop and, with class ids, their per-class maxima on the classes' own
+    # graphs (-inf for classes without rows in the block)
+    if class_id is None:
+        product = adjacency_product_rows(features, features, row_start, row_stop, tile_size=tile_size,
+                                         num_neighbours=num_neighbours)
+        return np.tanh(np.add(input_hidden[row_start: row_stop], product)), None
+    product, class_product = adjacency_product_rows(features, features, row_start, row_stop, class_id, tile_size,
+                                                    same_class_product=True, num_neighbours=num_neighbours)
+    # the rows of a task are sorted by class (TaskClassGrouping), so each class is a run of rows and one reduceat
+    # over the run starts takes all the maxima; maximum.at then only sees one row per run
+    block_class_id = class_id[row_start: row_stop]
+    run_starts = np.flatnonzero(np.concatenate([[True], block_class_id[1:] != block_class_id[:-1]]))
+    class_embedding_vectors = np.full([num_class, input_hidden.shape[1]], -np.inf, dtype=product.dtype)
+    np.maximum.at(class_embedding_vectors, block_class_id[run_starts], np.maximum.reduceat(
+        np.tanh(np.add(input_hidden[row_start: row_stop], class_product)), run_starts, axis=0))
+    return np.tanh(np.add(input_hidden[row_start: row_stop], product)), class_embedding_vectors
+
+
+def second_round_max(input_hidden, new_features, row_start, row_stop, class_id=None, tile_size=1024,
+                     num_neighbours=0):
+    product = adjacency_product_rows(new_features, new_features, row_start, row_stop, class_id, tile_size,
+                                     num_neighbours=num_neighbours)
+    return np.max(np.tanh(np.add(input_hidden[row_start: row_stop], product)), 0)
+
+
+def streaming_graph_embeddings(input_hidden, features, class_id=None, num_class=0, tile_size=1024, num_neighbours=0):
+    # Two rounds of tanh(input_hidden + A @ features) over the instance graph of one task, reduced to the task
+    # embedding (max over the second-round rows) and, with class ids, the class embeddings (max over the rows of
+    # each class of one round on the class's own graph). Second-round rows and class rows are folded into running
+    # maxima as soon as their row block is done, so besides the inputs only the first-round features are kept and
+    # memory is O(n * H). num_neighbours > 0 propagates over the same top-k graph as training with top_k_neighbours
+    new_features = np.empty([features.shape[0], input_hidden.shape[1]], dtype=np.result_type(input_hidden, features))
+    class_embedding_vectors = None
+    for row_start, row_stop in iterate_tiles(features.shape[0], tile_size):
+        new_features[row_start: row_stop], class_max = first_round_rows(input_hidden, features, row_start, row_stop,
+                                                                        class_id, num_class, tile_size, num_neighbours)
+        if class_max is not None:
+            class_embedding_vectors = class_max if class_embedding_vectors is None else np.maximum(
+                class_embedding_vectors, class_max)
+    task_embedding_vector = np.full(input_hidden.shape[1], -np.inf, dtype=new_features.dtype)
+    for row_start, row_stop in iterate_tiles(features.shape[0], tile_size):
+        task_embedding_vector = np.maximum(task_embedding_vector, second_round_max(
+            input_hidden, new_features, row_start, row_stop, class_id, tile_size, num_neighbours))
+    return task_embedding_vector, class_embedding_vectors
+
+
+def streaming_similarity_embedding(features, values, tile_size=1024):
+    # max over rows of tanh(softmax(S) @ values), S being the cosine similarity matrix of the rows of features with
+    # the softmax normalised over the whole matrix. The first pass only finds the normaliser; the second computes
+    # the rows block by block and folds them into a running max, so no n x n or n x H intermediate is kept
+    num_rows = features.shape[0]
+    norm = np.sqrt(np.sum(np.square(features), 1))
+
+    def similarity_block(row_start, row_stop, col_start, col_stop):
+        return np.dot(features[row_start: row_stop], features[col_start: col_stop].transpose()) / (
+            norm[row_start: row_stop, None] * norm[None, col_start: col_stop])
+
+    running_max = -np.inf
+    total = 0.
+    for row_start, row_stop in iterate_tiles(num_rows, tile_size):
+        for col_start, col_stop in iterate_tiles(num_rows, tile_size):
+            similarity = similarity_block(row_start, row_stop, col_start, col_stop)
+            block_max = np.max(similarity)
+            if block_max > running_max:
+                total *= np.exp(running_max - block_max)
+                running_max = block_max
+            total += np.sum(np.exp(similarity - running_max))
+    embedding_vector = np.full(values.shape[1], -np.inf, dtype=np.result_type(features, values))
+    for row_start, row_stop in iterate_tiles(num_rows, tile_size):
+        product = np.zeros([row_stop - row_start, values.shape[1]], dtype=embedding_vector.dtype)
+        for col_start, col_stop in iterate_tiles(num_rows, tile_size):
+            product += np.dot(np.exp(similarity_block(row_start, row_stop, col_start, col_stop) - running_max),
+                              values[col_start: col_stop])
+        embedding_vector = np.maximum(embedding_vector, np.max(np.tanh(product / total), 0))
+    return embedding_vector
+
+
+def task_graph_embeddings(input_hidden, hidden_features, grouping, num_class=0, tile_size=1024, pool=None,
+                          num_neighbours=0):
+    # streaming_graph_embeddings on every task of inputs already in grouping order, serially or on an EmbeddingPool;
+    # the class embeddings of all tasks come back stacked task-major, or None without class ids
+    if pool is not None:
+        task_embedding_vectors, class_embedding_vectors = pool.graph_embeddings(input_hidden, hidden_features)
+    else:
+        task_embedding_vectors, class_embedding_vectors = [], []
+        for task in range(grouping.task_offsets.size - 1):
+            rows = grouping.task_rows(task)
+            class_id = None if grouping.class_id is None else grouping.class_id[rows]
+            task_embedding_vector, class_embedding_vector = streaming_graph_embeddings(
+                input_hidden[rows], hidden_features[rows], class_id, num_class, tile_size, num_neighbours)
+            task_embedding_vectors.append(task_embedding_vector)
+            class_embedding_vectors.append(class_embedding_vector)
+    if grouping.class_id is None:
+        return task_embedding_vectors, None
+    return task_embedding_vectors, np.concatenate(class_embedding_vectors)
+
+
+def task_similarity_embeddings(features, values, grouping, tile_size=1024, pool=None):
+    if pool is not None:
+        return pool.similarity_embeddings(features, values)
+    return [streaming_similarity_embedding(features[grouping.task_rows(task)], values[grouping.task_rows(task)],
+                                           tile_size) for task in range(grouping.task_offsets.size - 1)]
+
+
+# Worker side of EmbeddingPool. Every worker maps each shared block once and keeps the mapping for the lifetime of
+# the pool; the functions only take picklable tuples so they run under the spawn start method.
+attached_blocks = {}
+
+
+def attach_shared_array(name, shape, dtype):
+    if name not in attached_blocks:
+        block = shared_memory.SharedMemory(name=name)
+        attached_blocks[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    return attached_blocks[name][1]
+
+
+def first_round_job(job):
+    data_block, class_block, task_start, task_stop, row_start, row_stop, num_class, tile_size, num_neighbours = job
+    input_hidden, features, new_features = attach_shared_array(*data_block)[:, task_start: task_stop]
+    class_id = None if class_block is None else attach_shared_array(*class_block)[task_start: task_stop]
+    new_features[row_start: row_stop], class_max = first_round_rows(input_hidden, features, row_start, row_stop,
+                                                                    class_id, num_class, tile_size, num_neighbours)
+    return class_max
+
+
+def second_round_job(job):
+    data_block, class_block, task_start, task_stop, row_start, row_stop, _, tile_size, num_neighbours = job
+    input_hidden, _, new_features = attach_shared_array(*data_block)[:, task_start: task_stop]
+    class_id = None if class_block is None else attach_shared_array(*class_block)[task_start: task_stop]
+    return second_round_max(input_hidden, new_features, row_start, row_stop, class_id, tile_size, num_neighbours)
+
+
+def similarity_job(job):
+    data_block, task_start, task_stop, tile_size = job
+    features, values, _ = attach_shared_array(*data_block)[:, task_start: task_stop]
+    return streaming_similarity_embedding(features, values, tile_size)
+
+
+def start_worker_pool(num_workers):
+    # spawn runs the parent's __main__ module again in every worker, as __mp_main__, and the training scripts import
+    # TensorFlow at the top. The workers only need this module, so it stands in for __main__ while they start
+    main_module = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        return multiprocessing.get_context('spawn').Pool(num_workers)
+    finally:
+        sys.modules['__main__'] = main_module
+
+
+class EmbeddingPool:
+    """Fan the per-task graph propagation of get_embedding_vec out to a pool of worker processes.
+
+    The per-evaluation arrays are copied once into a shared-memory block that every worker maps, instead of being
+    pickled per job. Jobs are row blocks of a task, so the pool keeps more cores busy than there are tasks. The
+    workers are spawned with hgnn_np as their main module, so they import NumPy and this module only, not the
+    launching script and TensorFlow.
+    """
+
+    def __init__(self, num_workers, grouping, num_class=0, tile_size=1024, num_neighbours=0):
+        self.grouping = grouping
+        self.num_class = num_class
+        self.tile_size = tile_size
+        self.num_neighbours = num_neighbours
+        self.pool = start_worker_pool(num_workers)
+        self.blocks = []
+        self.data_block = None
+        self.data_view = None
+        self.class_block = None
+        if grouping.class_id is not None:
+            self.class_block = self.share(np.ascontiguousarray(grouping.class_id, dtype=np.int64))
+
+    def allocate(self, shape, dtype):
+        # a new shared block and the parent's view of it
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        self.blocks.append(block)
+        return (block.name, tuple(shape), dtype.str), np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def share(self, array):
+        shared_array, view = self.allocate(array.shape, array.dtype)
+        view[...] = array
+        return shared_array
+
+    def share_data(self, first, second):
+        # one [3, n, H] block per pool, reused by every evaluation: the two inputs are written straight into it, and
+        # the third slot is room for the first-round features
+        shape, dtype = (3,) + first.shape, np.result_type(first, second)
+        if self.data_block is None or self.data_block[1] != shape or self.data_block[2] != dtype.str:
+            self.data_block, self.data_view = self.allocate(shape, dtype)
+        self.data_view[0] = first
+        self.data_view[1] = second
+        return self.data_block
+
+    def jobs(self, data_block):
+        jobs = []
+        for task in range(self.grouping.task_offsets.size - 1):
+            task_start, task_stop = self.grouping.task_offsets[task], self.grouping.task_offsets[task + 1]
+            for row_start, row_stop in iterate_tiles(task_stop - task_start, self.tile_size):
+                jobs.append((task, (data_block, self.class_block, task_start, task_stop, row_start, row_stop,
+                                    self.num_class, self.tile_size, self.num_neighbours)))
+        return jobs
+
+    def graph_embeddings(self, input_hidden, hidden_features):
+        # same results as streaming_graph_embeddings on every task of the (grouped) inputs
+        jobs = self.jobs(self.share_data(input_hidden, hidden_features))
+        num_task = self.grouping.task_offsets.size - 1
+        class_embedding_vectors = [None] * num_task
+        for (task, _), class_max in zip(jobs, self.pool.map(first_round_job, [job for _, job in jobs])):
+            if class_max is not None:
+                class_embedding_vectors[task] = class_max if class_embedding_vectors[task] is None else np.maximum(
+                    class_embedding_vectors[task], class_max)
+        task_embedding_vectors = [None] * num_task
+        for (task, _), row_max in zip(jobs, self.pool.map(second_round_job, [job for _, job in jobs])):
+            task_embedding_vectors[task] = row_max if task_embedding_vectors[task] is None else np.maximum(
+                task_embedding_vectors[task], row_max)
+        return task_embedding_vectors, class_embedding_vectors
+
+    def similarity_embeddings(self, features, values):
+        # same results as streaming_similarity_embedding on every task; the softmax is normalised per task, so jobs
+        # are whole tasks
+        data_block = self.share_data(features, values)
+        offsets = self.grouping.task_offsets
+        return self.pool.map(similarity_job, [(data_block, offsets[task], offsets[task + 1], self.tile_size)
+                                              for task in range(offsets.size - 1)])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        # the parent's view has to go before its block can be closed
+        self.data_view = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
@@ -0,0 +1,122 @@
+import numpy as np
+import tensorflow as tf
+import queue
+import threading
+import time
+
+
+class BatchPrefetcher:
+    """Run MTDataset.get_next_batch on a worker thread, num_prefetch batches ahead, in the dataset's own order.
+
+    A returned batch stays valid until the next call to get_next_batch(). With record_state, get_state() returns the
+    dataset state right after the last batch handed out, not after the batches sampled ahead.
+    """
+
+    def __init__(self, dataset, num_prefetch, record_state=False):
+        self.dataset = dataset
+        self.num_prefetch = num_prefetch
+        self.record_state = record_state
+        self.state = dataset.get_state() if record_state else None
+        # one spare buffer set: the consumer holds on to the batch it is using while the queue is full
+        self.free_buffers = queue.Queue()
+        for _ in range(num_prefetch + 1):
+            self.free_buffers.put(dataset.allocate_batch())
+        self.ready_batches = queue.Queue(maxsize=num_prefetch)
+        self.current_buffers = None
+        self.num_produced = 0
+        self.num_consumed = 0
+        self.num_stalls = 0
+        self.stall_time = 0.
+        self.queue_depth_sum = 0
+        self.stop_event = threading.Event()
+        self.worker = threading.Thread(target=self.__produce__, name='batch-prefetcher', daemon=True)
+        self.worker.start()
+
+    def __produce__(self):
+        while not self.stop_event.is_set():
+            buffers = self.free_buffers.get()
+            if buffers is None:
+                return
+            try:
+                batch = self.dataset.get_next_batch(*buffers)
+                item = (buffers, batch, self.dataset.get_state() if self.record_state else None, None)
+            except Exception as error:
+                item = (None, None, None, error)
+            self.ready_batches.put(item)
+            self.num_produced += 1
+            if item[3] is not None:
+                return
+
+    def get_next_batch(self):
+        if self.current_buffers is not None:
+            self.free_buffers.put(self.current_buffers)
+            self.current_buffers = None
+        depth = self.ready_batches.qsize()
+        self.queue_depth_sum += depth
+        if depth == 0:
+            self.num_stalls += 1
+            start = time.time()
+            buffers, batch, state, error = self.ready_batches.get()
+            self.stall_time += time.time() - start
+        else:
+            buffers, batch, state, error = self.ready_batches.get()
+        if error is not None:
+            raise error
+        self.current_buffers = buffers
+        self.state = state
+        self.num_consumed += 1
+        return batch
+
+    def get_state(self):
+        return self.state
+
+    def get_stats(self):
+        return {'num_prefetch': self.num_prefetch,
+                'produced': self.num_produced,
+                'consumed': self.num_consumed,
+                'stalls': self.num_stalls,
+                'stall_time': self.stall_time,
+                'mean_queue_depth': self.queue_depth_sum / max(self.num_consumed, 1)}
+
+    def close(self):
+        self.stop_event.set()
+        self.free_buffers.put(None)
+        while self.worker.is_alive():
+            try:
+                self.ready_batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.worker.join()
+
+
+class TFDataBatches:
+    """Express MTDataset sampling as a tf.data pipeline that feeds the graph without feed_dict.
+
+    The sampler only produces the row indices of each batch; the rows are gathered inside the pipeline from a copy
+    of the training matrix that lives on the TensorFlow side.
+    """
+
+    def __init__(self, dataset, with_label=False, num_parallel_calls=4, buffer_size=2):
+        self.dataset = dataset
+        self.data_init = tf.placeholder(tf.as_dtype(dataset.data.dtype), shape=dataset.data.shape)
+        # a local variable is neither trained nor checkpointed, and is filled once from data_init
+        self.data_var = tf.Variable(self.data_init, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        label = tf.constant(np.reshape(dataset.label, [-1]).astype(np.float32))
+
+        def gather_batch(index):
+            batch_data = tf.cast(tf.gather(self.data_var, index), tf.float32)
+            if with_label:
+                return batch_data, tf.reshape(tf.gather(label, index), [-1, 1])
+            return batch_data, index
+
+        num_ins = dataset.sampled_data.shape[0]
+        index_dataset = tf.data.Dataset.from_generator(lambda: iter(dataset.get_next_batch_index, None), tf.int64,
+                                                       tf.TensorShape([num_ins]))
+        batches = index_dataset.map(gather_batch, num_parallel_calls=num_parallel_calls).prefetch(buffer_size)
+        self.iterator = tf.data.make_initializable_iterator(batches)
+        self.data, second = self.iterator.get_next()
+        self.data.set_shape([num_ins, dataset.data_dim])
+        self.label = second if with_label else None
+
+    def initialize(self, sess):
+        sess.run([self.data_var.initializer, self.iterator.initializer], feed_dict={self.data_init: self.dataset.data})
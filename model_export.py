@@ -0,0 +1,50 @@
+import numpy as np
+import json
+import os
+import struct
+
+
+MAGIC = b'HGNNEXP1'
+ALIGNMENT = 64
+
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def export_model(path, arrays, meta):
+    # layout: MAGIC, the header length as a little-endian uint64, a JSON header with meta and the dtype, shape and
+    # offset of every array, then the raw C-ordered arrays. The data section and every array in it start on an
+    # ALIGNMENT-byte boundary, so the arrays can be mapped in place
+    arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items()}
+    table = {}
+    offset = 0
+    for name, value in arrays.items():
+        table[name] = {'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset}
+        offset = align(offset + value.nbytes)
+    header = json.dumps({'meta': meta, 'arrays': table}, sort_keys=True).encode('utf-8')
+    data_start = align(len(MAGIC) + 8 + len(header))
+    # written next to the target and renamed into place, so a server never maps a half-written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, value in arrays.items():
+            file.write(b'\0' * (data_start + table[name]['offset'] - file.tell()))
+            file.write(value.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_model(path):
+    # the arrays are read-only views of one memory map, so loading costs no copy and processes serving the same
+    # file share its pages
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError('%s is not an exported HGNN model' % path)
+    header_size = struct.unpack('<Q', bytes(buffer[len(MAGIC): len(MAGIC) + 8]))[0]
+    header = json.loads(bytes(buffer[len(MAGIC) + 8: len(MAGIC) + 8 + header_size]).decode('utf-8'))
+    data_start = align(len(MAGIC) + 8 + header_size)
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        arrays[name] = np.ndarray(entry['shape'], dtype=np.dtype(entry['dtype']), buffer=buffer,
+                                  offset=data_start + entry['offset'])
+    return arrays, header['meta']
@@ -0,0 +1,92 @@
+import numpy as np
+from model_export import load_model
+
+
+def activate_np(temp, activate_op):
+    if activate_op == 1:
+        return np.tanh(temp)
+    elif activate_op == 2:
+        return np.maximum(temp, 0)
+    elif activate_op == 3:
+        return np.where(temp > 0, temp, np.expm1(np.minimum(temp, 0)))
+    raise ValueError('unknown activate_op %s' % activate_op)
+
+
+class NumpyPredictor:
+    """Score samples of any mix of tasks from a model written by model_export.export_model, with NumPy only.
+
+    Classification gives the same predictions as get_new_hidden_features followed by the argmax of compute_errors;
+    regression returns the output layer. Everything that does not depend on the samples is computed once, at load
+    time.
+    """
+
+    def __init__(self, path, chunk_size=256):
+        arrays, self.meta = load_model(path)
+        self.input_hidden_weights = arrays['input_hidden_weights']
+        hidden_output_weight = arrays['hidden_output_weight']
+        task_embedding_vectors = arrays['task_embedding_vectors']
+        self.num_task = hidden_output_weight.shape[0]
+        self.activate_op = self.meta['activate_op']
+        self.is_classification = self.meta['kind'] == 'classification'
+        self.chunk_size = chunk_size
+        hidden_dim = self.input_hidden_weights.shape[1]
+        class_start = hidden_dim + task_embedding_vectors.shape[1]
+        # the output layer is linear over [hidden, task embedding, class embedding]; only the hidden part depends on
+        # the sample, the task part is one bias per task
+        self.hidden_output_weight = hidden_output_weight[:, :hidden_dim]
+        self.task_logits = np.einsum('tf,tfk->tk', task_embedding_vectors, hidden_output_weight[:, hidden_dim: class_start])
+        if self.is_classification:
+            num_class = self.meta['num_class']
+            class_embedding_vectors = arrays['class_embedding_vectors']
+            class_weight = hidden_output_weight[:, class_start:]
+            # same indexing as get_new_hidden_features: candidates are ranked with rows task * num_task + j, the
+            # chosen class is scored with row task * num_class + j
+            candidate_ind = np.arange(self.num_task)[:, None] * self.num_task + np.arange(num_class)
+            self.candidate_logits = np.matmul(class_embedding_vectors[candidate_ind], class_weight)
+            self.class_logits = np.matmul(np.reshape(class_embedding_vectors, [self.num_task, num_class, -1]),
+                                          class_weight)
+
+    def select_class(self, shared_logits, task):
+        class_id = np.zeros(shared_logits.shape[0], dtype=np.int64)
+        for start in range(0, shared_logits.shape[0], self.chunk_size):
+            logits = shared_logits[start: start + self.chunk_size, None, :] + self.candidate_logits[task]
+            max_logits = np.max(logits, 2, keepdims=True)
+            log_normalizer = max_logits[:, :, 0] + np.log(np.sum(np.exp(logits - max_logits), 2))
+            class_id[start: start + self.chunk_size] = np.argmax(
+                np.diagonal(logits, axis1=1, axis2=2) - log_normalizer, 1)
+        return class_id
+
+    def predict(self, data, task_ind):
+        # task_ind is one task id per row, or a single id for the whole batch
+        data = np.atleast_2d(data)
+        task_ind = np.broadcast_to(np.reshape(task_ind, [-1]), [data.shape[0]])
+        # rows of other ids would fall outside every task's slice below and come back as class 0
+        bad_task_ind = np.unique(task_ind[(task_ind < 0) | (task_ind >= self.num_task)])
+        if bad_task_ind.size:
+            raise ValueError('task ids must be in [0, %d), got %s' % (self.num_task, bad_task_ind.tolist()))
+        hidden_rep = activate_np(np.matmul(data, self.input_hidden_weights), self.activate_op)
+        prediction = np.zeros(data.shape[0], dtype=np.int64 if self.is_classification else hidden_rep.dtype)
+        order = np.argsort(task_ind, kind='stable')
+        bounds = np.searchsorted(task_ind[order], np.arange(self.num_task + 1))
+        for task in np.flatnonzero(np.diff(bounds)):
+            rows = order[bounds[task]: bounds[task + 1]]
+            shared_logits = np.matmul(hidden_rep[rows], self.hidden_output_weight[task]) + self.task_logits[task]
+            if not self.is_classification:
+                prediction[rows] = shared_logits[:, 0]
+                continue
+            class_id = self.select_class(shared_logits, task)
+            prediction[rows] = np.argmax(shared_logits + self.class_logits[task][class_id], 1)
+        return prediction
+
+    def errors(self, data, task_ind, label):
+        # same [1, num_task + 1] layout as compute_errors: per-task error rate (classification) or mean squared error
+        # (regression), then their mean
+        task_ind = np.reshape(task_ind, [-1])
+        prediction = self.predict(data, task_ind)
+        label = np.reshape(label, [-1])
+        loss = prediction != label if self.is_classification else np.square(prediction - label)
+        errors = np.zeros([1, self.num_task + 1])
+        errors[0, 0: self.num_task] = np.bincount(task_ind, loss, self.num_task) / np.bincount(
+            task_ind, minlength=self.num_task)
+        errors[0, self.num_task] = np.mean(errors[0, 0: self.num_task])
+        return errors
@@ -0,0 +1,203 @@
+import numpy as np
+import argparse
+import collections
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from predictor import NumpyPredictor
+
+
+class PendingRequest:
+    def __init__(self, data, task_ind):
+        self.data = data
+        self.task_ind = task_ind
+        self.start_time = time.time()
+        self.done = threading.Event()
+        self.prediction = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Coalesce concurrent predict() calls into micro-batches that the predictor scores in one vectorized pass.
+
+    A batch is closed once it holds max_batch_size rows or max_wait seconds after its first request arrived,
+    whichever comes first. A request that would overflow the batch opens the next one instead; only a request with
+    more than max_batch_size rows by itself makes a larger batch, of that request alone. Latencies of the last stats_window requests and a histogram of batch sizes are kept for
+    get_stats().
+    """
+
+    def __init__(self, predictor, max_batch_size=64, max_wait=0.002, stats_window=10000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.latency = collections.deque(maxlen=stats_window)
+        self.batch_size_histogram = collections.Counter()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.worker = threading.Thread(target=self.__serve__, name='micro-batcher', daemon=True)
+        self.worker.start()
+
+    def predict(self, data, task_ind):
+        # checked here, so a malformed request fails on its own instead of failing the batch it would join
+        data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        if data.ndim != 2 or data.shape[1] != self.predictor.input_hidden_weights.shape[0]:
+            raise ValueError('expected rows of %d features' % self.predictor.input_hidden_weights.shape[0])
+        task_ind = np.asarray(task_ind)
+        # a cast would truncate task 1.7 to task 1; floats are only taken when they hold whole numbers
+        if task_ind.dtype.kind == 'f':
+            if not np.all(np.isfinite(task_ind) & (task_ind == np.round(task_ind))):
+                raise ValueError('task ids must be integers')
+        elif task_ind.dtype.kind not in 'iu':
+            raise ValueError('task ids must be integers')
+        task_ind = np.broadcast_to(np.reshape(task_ind.astype(np.int64), [-1]), [data.shape[0]])
+        if np.any(task_ind < 0) or np.any(task_ind >= self.predictor.num_task):
+            raise ValueError('task ids must be in [0, %d)' % self.predictor.num_task)
+        request = PendingRequest(data, task_ind)
+        self.pending.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.prediction
+
+    def __serve__(self):
+        carried = None
+        while True:
+            request = self.pending.get() if carried is None else carried
+            carried = None
+            if request is None:
+                return
+            batch = [request]
+            num_rows = request.data.shape[0]
+            deadline = request.start_time + self.max_wait
+            stop = False
+            while num_rows < self.max_batch_size:
+                # past the deadline, requests that are already queued still join without waiting
+                try:
+                    request = self.pending.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                if num_rows + request.data.shape[0] > self.max_batch_size:
+                    carried = request
+                    break
+                batch.append(request)
+                num_rows += request.data.shape[0]
+            self.score(batch, num_rows)
+            if stop:
+                return
+
+    def score(self, batch, num_rows):
+        try:
+            prediction = self.predictor.predict(np.concatenate([request.data for request in batch]),
+                                                np.concatenate([request.task_ind for request in batch]))
+            for request, part in zip(batch, np.split(prediction, np.cumsum([r.data.shape[0] for r in batch])[:-1])):
+                request.prediction = part
+        except Exception as error:
+            for request in batch:
+                request.error = error
+        end_time = time.time()
+        with self.lock:
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            # power-of-two buckets keep the histogram short for any max_batch_size
+            self.batch_size_histogram[1 << (num_rows - 1).bit_length()] += 1
+            self.latency.extend(end_time - request.start_time for request in batch)
+        for request in batch:
+            request.done.set()
+
+    def get_stats(self):
+        with self.lock:
+            latency = 1000 * np.array(self.latency)
+            stats = {'requests': self.num_requests,
+                     'batches': self.num_batches,
+                     'batch_size_histogram': {'<=%d' % size: count
+                                              for size, count in sorted(self.batch_size_histogram.items())}}
+        if latency.size:
+            stats['latency_ms'] = {'p50': np.percentile(latency, 50), 'p90': np.percentile(latency, 90),
+                                   'p99': np.percentile(latency, 99), 'max': np.max(latency)}
+        return stats
+
+    def close(self):
+        self.pending.put(None)
+        self.worker.join()
+
+
+def make_handler(batcher):
+    class PredictHandler(BaseHTTPRequestHandler):
+        # POST /predict with {"data": [[...], ...], "task": id or [ids]} -> {"prediction": [...]}; GET /stats
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self.send_json(404, {'error': 'unknown path %s' % self.path})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                prediction = batcher.predict(request['data'], request['task'])
+            except KeyError as error:
+                return self.send_json(400, {'error': 'missing field %s' % error})
+            except (ValueError, TypeError) as error:
+                return self.send_json(400, {'error': str(error)})
+            except Exception as error:
+                return self.send_json(500, {'error': '%s: %s' % (type(error).__name__, error)})
+            self.send_json(200, {'prediction': prediction.tolist()})
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self.send_json(404, {'error': 'unknown path %s' % self.path})
+            self.send_json(200, batcher.get_stats())
+
+        def send_json(self, status, body):
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # one line per request would cost more than scoring a micro-batch; get_stats() covers it
+            pass
+
+    return PredictHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher, host='127.0.0.1', port=0, unix_socket=None):
+    # port 0 picks a free port; server.server_address tells which
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, make_handler(batcher))
+    return ThreadingHTTPServer((host, port), make_handler(batcher))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve predictions of an exported HGNN model.')
+    parser.add_argument('model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.)
+    args = parser.parse_args()
+    batcher = MicroBatcher(NumpyPredictor(args.model), args.max_batch_size, args.max_wait_ms / 1000)
+    server = make_server(batcher, args.host, args.port, args.unix_socket)
+    print('serving %s on %s' % (args.model, server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
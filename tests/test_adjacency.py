@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import DMTL_HGNN
+from DMTL_HGNN import compute_adjacency_matrix, compute_sign_matrix, get_block_sign_matrix, get_block_node_class, \
+    message_passing
+from benchmarks import legacy_adjacency_matrix
+
+
+num_task, num_class, batch_size, hidden_dim = 3, 5, 4, 16
+
+
+def make_inputs(seed=0, num_task=num_task, num_class=num_class, batch_size=batch_size, hidden_dim=hidden_dim):
+    # task-major, class-major rows in blocks of batch_size, the layout MTDataset batches have
+    rng = np.random.RandomState(seed)
+    features = rng.randn(num_task * num_class * batch_size, hidden_dim).astype(np.float32) * 0.3
+    label = np.eye(num_class, dtype=np.float32)[np.tile(np.repeat(np.arange(num_class), batch_size), num_task)]
+    return features, label
+
+
+def run(build, features, label):
+    with tf.Graph().as_default():
+        hidden_features = tf.constant(features)
+        inputs_data_label = tf.placeholder_with_default(label, shape=[None, num_class])
+        output = build(hidden_features, inputs_data_label)
+        with tf.Session() as sess:
+            return sess.run(output)
+
+
+@pytest.mark.parametrize('sign', ['labels', 'block'])
+def test_batched_adjacency_matches_per_task_loop(sign):
+    features, label = make_inputs()
+
+    def build(hidden_features, inputs_data_label):
+        if sign == 'labels':
+            sign_matrix = compute_sign_matrix(inputs_data_label, num_task)
+        else:
+            sign_matrix = get_block_sign_matrix(num_class, batch_size)
+        return (legacy_adjacency_matrix(hidden_features, inputs_data_label, num_task),
+                compute_adjacency_matrix(hidden_features, sign_matrix, num_task))
+
+    reference, adjacency_matrix = run(build, features, label)
+    assert adjacency_matrix.shape == (num_task, num_class * batch_size, num_class * batch_size)
+    np.testing.assert_allclose(adjacency_matrix, reference, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('num_neighbours', [5, num_class * batch_size])
+def test_top_k_message_passing_matches_masked_dense_graph(monkeypatch, num_neighbours):
+    features, label = make_inputs(1)
+    monkeypatch.setattr(DMTL_HGNN, 'top_k_neighbours', num_neighbours)
+    # several row tiles per task, the last one partial
+    monkeypatch.setattr(DMTL_HGNN, 'adjacency_tile_size', 7)
+
+    def build(hidden_features, inputs_data_label):
+        adjacency_matrix = compute_adjacency_matrix(
+            hidden_features, get_block_node_class(num_task, num_class, batch_size), num_task)
+        return message_passing(adjacency_matrix, tf.reshape(hidden_features, [num_task, -1, hidden_dim]))
+
+    messages = run(build, features, label)
+    task_features = np.reshape(features, [num_task, -1, hidden_dim])
+    dist = np.sum((task_features[:, :, None] - task_features[:, None]) ** 2, -1)
+    block_id = np.repeat(np.arange(num_class), batch_size)
+    adjacency_matrix = np.exp(-dist) * np.where(block_id[:, None] == block_id[None], 1, -1)
+    keep = np.zeros(adjacency_matrix.shape, dtype=bool)
+    np.put_along_axis(keep, np.argsort(dist, -1)[..., :num_neighbours], True, -1)
+    np.testing.assert_allclose(messages, np.matmul(adjacency_matrix * keep, task_features), rtol=1e-4, atol=1e-5)
+
+
+def top_k_messages(hidden_features, num_task, num_class, batch_size, hidden_dim):
+    adjacency_matrix = compute_adjacency_matrix(
+        hidden_features, get_block_node_class(num_task, num_class, batch_size), num_task)
+    return message_passing(adjacency_matrix, tf.reshape(hidden_features, [num_task, -1, hidden_dim]))
+
+
+def test_top_k_gradient_matches_masked_dense_graph(monkeypatch):
+    features, _ = make_inputs(2)
+    num_neighbours = 6
+    monkeypatch.setattr(DMTL_HGNN, 'top_k_neighbours', num_neighbours)
+    monkeypatch.setattr(DMTL_HGNN, 'adjacency_tile_size', 7)
+    task_features = np.reshape(features, [num_task, -1, hidden_dim])
+    dist = np.sum((task_features[:, :, None] - task_features[:, None]) ** 2, -1)
+    keep = np.zeros(dist.shape, dtype=np.float32)
+    np.put_along_axis(keep, np.argsort(dist, -1)[..., :num_neighbours], 1, -1)
+    block_id = np.repeat(np.arange(num_class), batch_size)
+    sign = np.where(block_id[:, None] == block_id[None], 1, -1).astype(np.float32)
+    upstream = np.random.RandomState(3).randn(*task_features.shape).astype(np.float32)
+
+    with tf.Graph().as_default():
+        hidden_features = tf.constant(features)
+        messages = top_k_messages(hidden_features, num_task, num_class, batch_size, hidden_dim)
+        task_hidden = tf.reshape(hidden_features, [num_task, -1, hidden_dim])
+        sq_norm = tf.reduce_sum(tf.square(task_hidden), -1, keepdims=True)
+        dense_dist = sq_norm - 2 * tf.matmul(task_hidden, task_hidden, transpose_b=True) + tf.matrix_transpose(sq_norm)
+        dense_messages = tf.matmul(tf.exp(-dense_dist) * sign * keep, task_hidden)
+        gradients = [tf.gradients(tf.reduce_sum(output * upstream), hidden_features)[0]
+                     for output in (messages, dense_messages)]
+        with tf.Session() as sess:
+            gradient, dense_gradient = sess.run(gradients)
+    np.testing.assert_allclose(gradient, dense_gradient, rtol=1e-4, atol=1e-4)
+
+
+def test_top_k_never_allocates_a_dense_sized_tensor(monkeypatch):
+    # 2 tasks of 128 rows, 8 neighbours of 16-d features: a dense [T, n, n] adjacency and the [T, n, k, d] gathered
+    # neighbour rows are both 128 KiB, a row tile is 8 KiB
+    num_task, num_class, batch_size, hidden_dim = 2, 16, 8, 16
+    features, _ = make_inputs(4, num_task, num_class, batch_size, hidden_dim)
+    monkeypatch.setattr(DMTL_HGNN, 'top_k_neighbours', 8)
+    monkeypatch.setattr(DMTL_HGNN, 'adjacency_tile_size', 8)
+    dense_bytes = num_task * (num_class * batch_size) ** 2 * 4
+
+    with tf.Graph().as_default():
+        hidden_features = tf.Variable(features)
+        messages = top_k_messages(hidden_features, num_task, num_class, batch_size, hidden_dim)
+        gradient = tf.gradients(tf.reduce_sum(tf.square(messages)), hidden_features)[0]
+        with tf.Session() as sess:
+            sess.run(hidden_features.initializer)
+            run_metadata = tf.RunMetadata()
+            sess.run(gradient, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), run_metadata=run_metadata)
+    allocations = {node.node_name: output.tensor_description.allocation_description.requested_bytes
+                   for device in run_metadata.step_stats.dev_stats for node in device.node_stats
+                   for output in node.output}
+    assert allocations
+    largest = max(allocations, key=allocations.get)
+    assert allocations[largest] < dense_bytes // 2, largest
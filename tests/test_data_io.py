@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+import data_io
+from data_io import convert_data_file, parse_data_file, read_data_from_file
+
+
+def write_data_file(path, num_ins=10, seed=0):
+    # two tasks, three classes, five features
+    rng = np.random.RandomState(seed)
+    with open(path, 'w') as file:
+        file.write('2\n3\n0,4,%d\n' % num_ins)
+        for row in rng.randn(num_ins, 5):
+            file.write(','.join('%g' % value for value in row) + '\n')
+        file.write(','.join(str(value) for value in rng.randint(0, 3, num_ins)) + '\n')
+
+
+@pytest.fixture
+def hash_calls(monkeypatch):
+    calls = []
+    hash_file = data_io.hash_file
+    monkeypatch.setattr(data_io, 'hash_file', lambda filename, *args: calls.append(filename) or hash_file(filename, *args))
+    return calls
+
+
+def assert_same_dataset(dataset, expected):
+    assert len(dataset) == len(expected)
+    for value, expected_value in zip(dataset, expected):
+        np.testing.assert_array_equal(value, expected_value)
+
+
+def test_cache_hit_does_not_hash_the_source(tmp_path, hash_calls):
+    path = str(tmp_path / 'data.txt')
+    write_data_file(path)
+    expected = parse_data_file(path)
+    assert_same_dataset(read_data_from_file(path), expected)
+    del hash_calls[:]
+    dataset = read_data_from_file(path)
+    assert hash_calls == []
+    assert isinstance(dataset[0], np.memmap)
+    assert_same_dataset(dataset, expected)
+
+
+def test_touched_source_is_hashed_once_and_kept(tmp_path, hash_calls):
+    path = str(tmp_path / 'data.txt')
+    write_data_file(path)
+    read_data_from_file(path)
+    os.utime(path, ns=(1, 1))
+    del hash_calls[:]
+    assert isinstance(read_data_from_file(path)[0], np.memmap)
+    assert len(hash_calls) == 1
+    del hash_calls[:]
+    read_data_from_file(path)
+    assert hash_calls == []
+
+
+def test_edited_source_rebuilds_the_cache(tmp_path):
+    path = str(tmp_path / 'data.txt')
+    write_data_file(path)
+    read_data_from_file(path)
+    write_data_file(path, num_ins=12, seed=1)
+    assert_same_dataset(read_data_from_file(path), parse_data_file(path))
+
+
+def test_truncated_cache_is_parsed_again(tmp_path):
+    path = str(tmp_path / 'data.txt')
+    write_data_file(path)
+    with open(os.path.join(convert_data_file(path), 'data.npy'), 'r+b') as file:
+        file.truncate(100)
+    assert_same_dataset(read_data_from_file(path), parse_data_file(path))
+    assert isinstance(read_data_from_file(path)[0], np.memmap)
+
+
+def test_unwritable_cache_falls_back_to_parsing(tmp_path):
+    path = str(tmp_path / 'data.txt')
+    write_data_file(path)
+    # a regular file where the cache directory should go fails like a read-only data directory, also as root
+    (tmp_path / data_io.CACHE_DIR).write_text('')
+    assert_same_dataset(read_data_from_file(path), parse_data_file(path))
+    with pytest.raises(OSError):
+        convert_data_file(path)
@@ -0,0 +1,163 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from hgnn_np import (EmbeddingPool, TaskClassGrouping, adjacency_product_rows, first_round_rows,
+                     streaming_graph_embeddings, streaming_similarity_embedding, task_graph_embeddings,
+                     task_similarity_embeddings)
+
+
+def make_task(num_rows=37, hidden_dim=6, num_class=4, seed=0):
+    # rows sorted by class, as TaskClassGrouping lays a task out; the last class has a single row
+    rng = np.random.RandomState(seed)
+    features = rng.randn(num_rows, hidden_dim) * 0.4
+    input_hidden = rng.randn(num_rows, hidden_dim)
+    class_id = np.sort(rng.randint(0, num_class - 1, num_rows))
+    class_id[-1] = num_class - 1
+    return input_hidden, features, class_id
+
+
+def dense_adjacency(features, class_id=None):
+    # the untiled instance graph exp(-||f_i - f_j||^2) * s_ij
+    adjacency_matrix = np.exp(-np.sum((features[:, None] - features[None]) ** 2, -1))
+    if class_id is None:
+        return adjacency_matrix
+    return np.where(class_id[:, None] == class_id[None], adjacency_matrix, -adjacency_matrix)
+
+
+@pytest.mark.parametrize('tile_size', [1, 5, 16, 37, 1024])
+@pytest.mark.parametrize('with_class', [False, True])
+def test_tiled_adjacency_product_matches_dense(tile_size, with_class):
+    _, features, class_id = make_task()
+    class_id = class_id if with_class else None
+    values = np.random.RandomState(1).randn(*features.shape)
+    expected = np.dot(dense_adjacency(features, class_id), values)
+    for row_start, row_stop in [(0, 37), (3, 20), (36, 37)]:
+        product = adjacency_product_rows(features, values, row_start, row_stop, class_id, tile_size)
+        np.testing.assert_allclose(product, expected[row_start: row_stop], rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('tile_size', [5, 1024])
+def test_same_class_product_keeps_only_same_class_pairs(tile_size):
+    _, features, class_id = make_task()
+    values = np.random.RandomState(2).randn(*features.shape)
+    same_class = class_id[:, None] == class_id[None]
+    product, class_product = adjacency_product_rows(features, values, 4, 30, class_id, tile_size,
+                                                    same_class_product=True)
+    np.testing.assert_allclose(product, np.dot(dense_adjacency(features, class_id), values)[4: 30], rtol=1e-10)
+    np.testing.assert_allclose(class_product, np.dot(dense_adjacency(features) * same_class, values)[4: 30],
+                               rtol=1e-10)
+
+
+@pytest.mark.parametrize('num_neighbours', [1, 6, 37])
+def test_top_k_adjacency_product_matches_masked_dense(num_neighbours):
+    _, features, class_id = make_task()
+    values = np.random.RandomState(3).randn(*features.shape)
+    dist = np.sum((features[:, None] - features[None]) ** 2, -1)
+    keep = np.zeros(dist.shape, dtype=bool)
+    np.put_along_axis(keep, np.argsort(dist, 1)[:, :num_neighbours], True, 1)
+    product = adjacency_product_rows(features, values, 0, 37, class_id, 5, num_neighbours=num_neighbours)
+    np.testing.assert_allclose(product, np.dot(dense_adjacency(features, class_id) * keep, values), rtol=1e-10,
+                               atol=1e-12)
+
+
+def dense_graph_embeddings(input_hidden, features, class_id=None, num_class=0):
+    new_features = np.tanh(input_hidden + np.dot(dense_adjacency(features, class_id), features))
+    task_embedding_vector = np.max(np.tanh(input_hidden + np.dot(dense_adjacency(new_features, class_id),
+                                                                 new_features)), 0)
+    if class_id is None:
+        return task_embedding_vector, None
+    same_class = class_id[:, None] == class_id[None]
+    class_rows = np.tanh(input_hidden + np.dot(dense_adjacency(features) * same_class, features))
+    return task_embedding_vector, np.stack([np.max(class_rows[class_id == c], 0) for c in range(num_class)])
+
+
+@pytest.mark.parametrize('tile_size', [1, 5, 16, 1024])
+@pytest.mark.parametrize('with_class', [False, True])
+def test_streaming_graph_embeddings_match_dense(tile_size, with_class):
+    input_hidden, features, class_id = make_task()
+    class_id = class_id if with_class else None
+    num_class = 4 if with_class else 0
+    task_embedding_vector, class_embedding_vectors = streaming_graph_embeddings(input_hidden, features, class_id,
+                                                                                num_class, tile_size)
+    expected_task, expected_class = dense_graph_embeddings(input_hidden, features, class_id, num_class)
+    np.testing.assert_allclose(task_embedding_vector, expected_task, rtol=1e-10)
+    if with_class:
+        np.testing.assert_allclose(class_embedding_vectors, expected_class, rtol=1e-10)
+    else:
+        assert class_embedding_vectors is None
+
+
+def test_first_round_class_maxima_with_unsorted_classes():
+    # reduceat relies on class runs; a class split over several runs must still get the max of all of them
+    input_hidden, features, class_id = make_task()
+    class_id = np.random.RandomState(4).permutation(class_id)
+    _, class_max = first_round_rows(input_hidden, features, 2, 30, class_id, 4, 7)
+    same_class = class_id[:, None] == class_id[None]
+    class_rows = np.tanh(input_hidden + np.dot(dense_adjacency(features) * same_class, features))[2: 30]
+    for c in range(4):
+        rows = class_id[2: 30] == c
+        expected = np.max(class_rows[rows], 0) if rows.any() else np.full(features.shape[1], -np.inf)
+        np.testing.assert_allclose(class_max[c], expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('tile_size', [1, 6, 1024])
+def test_streaming_similarity_embedding_matches_dense(tile_size):
+    _, features, _ = make_task()
+    values = np.random.RandomState(5).randn(*features.shape)
+    norm = np.sqrt(np.sum(features ** 2, 1))
+    similarity = np.dot(features, features.transpose()) / (norm[:, None] * norm[None])
+    attention = np.exp(similarity) / np.sum(np.exp(similarity))
+    np.testing.assert_allclose(streaming_similarity_embedding(features, values, tile_size),
+                               np.max(np.tanh(np.dot(attention, values)), 0), rtol=1e-10)
+
+
+def worker_main_module(_):
+    # runs in a pool worker
+    return os.path.basename(getattr(sys.modules['__mp_main__'], '__file__', ''))
+
+
+@pytest.fixture(scope='module')
+def grouped_tasks():
+    # three tasks of uneven sizes in shuffled order; every task has every class and one class of task 2 has a
+    # single row
+    rng = np.random.RandomState(6)
+    task_ind = np.repeat([0, 1, 2], [23, 17, 9])
+    class_id = np.concatenate([rng.randint(0, 3, 23), rng.randint(0, 3, 17), [0, 0, 0, 1, 1, 1, 1, 1, 2]])
+    class_id[:3], class_id[23: 26] = [0, 1, 2], [0, 1, 2]
+    order = rng.permutation(task_ind.size)
+    grouping = TaskClassGrouping(task_ind[order], 3, class_id[order], 3)
+    input_hidden = grouping.gather(rng.randn(task_ind.size, 5))
+    features = grouping.gather(rng.randn(task_ind.size, 5) * 0.4)
+    return grouping, input_hidden, features
+
+
+@pytest.mark.parametrize('num_neighbours', [0, 4])
+def test_embedding_pool_matches_serial(grouped_tasks, num_neighbours):
+    grouping, input_hidden, features = grouped_tasks
+    task_serial, class_serial = task_graph_embeddings(input_hidden, features, grouping, 3, 4,
+                                                      num_neighbours=num_neighbours)
+    similarity_serial = task_similarity_embeddings(features, input_hidden, grouping, 4)
+    pool = EmbeddingPool(2, grouping, 3, 4, num_neighbours)
+    try:
+        assert set(pool.pool.map(worker_main_module, range(4))) == {'hgnn_np.py'}
+        # twice, so the second evaluation reuses the shared block of the first
+        for _ in range(2):
+            task_pool, class_pool = task_graph_embeddings(input_hidden, features, grouping, pool=pool)
+            np.testing.assert_allclose(np.stack(task_pool), np.stack(task_serial), rtol=1e-12)
+            np.testing.assert_allclose(class_pool, class_serial, rtol=1e-12)
+        similarity_pool = task_similarity_embeddings(features, input_hidden, grouping, pool=pool)
+        np.testing.assert_allclose(np.stack(similarity_pool), np.stack(similarity_serial), rtol=1e-12)
+    finally:
+        pool.close()
+    if num_neighbours:
+        return
+    # and the serial path, task by task, against the dense reference
+    for task in range(3):
+        rows = grouping.task_rows(task)
+        expected_task, expected_class = dense_graph_embeddings(input_hidden[rows], features[rows],
+                                                               grouping.class_id[rows], 3)
+        np.testing.assert_allclose(task_serial[task], expected_task, rtol=1e-10)
+        np.testing.assert_allclose(class_serial[3 * task: 3 * task + 3], expected_class, rtol=1e-10)
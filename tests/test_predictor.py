@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from benchmarks import make_exported_model
+from model_export import ALIGNMENT, export_model, load_model
+from predictor import NumpyPredictor
+
+
+num_task, num_class, dim, hidden_dim, embedding_dim = 3, 5, 12, 10, 4
+
+
+@pytest.fixture
+def classification_path(tmp_path):
+    path = str(tmp_path / 'model.hgnn')
+    make_exported_model(path, num_task, num_class, dim, hidden_dim, embedding_dim)
+    return path
+
+
+@pytest.fixture
+def regression_model(tmp_path):
+    rng = np.random.RandomState(1)
+    arrays = {'input_hidden_weights': rng.randn(dim, hidden_dim).astype(np.float32),
+              'hidden_output_weight': rng.randn(num_task, hidden_dim + embedding_dim, 1).astype(np.float32),
+              'task_embedding_vectors': rng.randn(num_task, embedding_dim).astype(np.float32)}
+    path = str(tmp_path / 'model_reg.hgnn')
+    export_model(path, arrays, {'model': 'synthetic', 'kind': 'regression', 'activate_op': 2})
+    return path, arrays
+
+
+def reference_classification(arrays, data, task_ind):
+    # one sample at a time, the way get_new_hidden_features and compute_errors score it
+    weights = arrays['hidden_output_weight']
+    task_embedding_vectors = arrays['task_embedding_vectors']
+    class_embedding_vectors = arrays['class_embedding_vectors']
+    prediction = []
+    for sample, task in zip(data, task_ind):
+        hidden = np.tanh(np.dot(sample, arrays['input_hidden_weights']))
+        scores = []
+        for j in range(num_class):
+            logits = np.dot(np.concatenate([hidden, task_embedding_vectors[task],
+                                            class_embedding_vectors[task * num_task + j]]), weights[task])
+            scores.append(logits[j] - np.log(np.sum(np.exp(logits - np.max(logits)))) - np.max(logits))
+        class_id = int(np.argmax(scores))
+        prediction.append(np.argmax(np.dot(np.concatenate([hidden, task_embedding_vectors[task],
+                                                           class_embedding_vectors[task * num_class + class_id]]),
+                                           weights[task])))
+    return np.array(prediction)
+
+
+def test_export_round_trip(classification_path):
+    arrays, meta = load_model(classification_path)
+    assert meta['kind'] == 'classification' and meta['num_class'] == num_class
+    make_exported_model(classification_path + '.copy', num_task, num_class, dim, hidden_dim, embedding_dim)
+    copy, _ = load_model(classification_path + '.copy')
+    for name, value in arrays.items():
+        np.testing.assert_array_equal(value, copy[name])
+        assert not value.flags.writeable
+        assert value.ctypes.data % ALIGNMENT == 0
+
+
+def test_classification_matches_reference(classification_path):
+    arrays, _ = load_model(classification_path)
+    predictor = NumpyPredictor(classification_path, chunk_size=7)
+    rng = np.random.RandomState(2)
+    data = rng.randn(40, dim).astype(np.float32)
+    task_ind = rng.randint(0, num_task, 40)
+    expected = reference_classification(arrays, data, task_ind)
+    np.testing.assert_array_equal(predictor.predict(data, task_ind), expected)
+    label = np.where(rng.rand(40) < 0.5, expected, (expected + 1) % num_class)
+    errors = predictor.errors(data, task_ind, label)
+    wrong = expected != label
+    expected_errors = [np.mean(wrong[task_ind == task]) for task in range(num_task)]
+    np.testing.assert_allclose(errors, [expected_errors + [np.mean(expected_errors)]])
+
+
+def test_single_task_id_applies_to_every_row(classification_path):
+    predictor = NumpyPredictor(classification_path)
+    data = np.random.RandomState(3).randn(6, dim).astype(np.float32)
+    np.testing.assert_array_equal(predictor.predict(data, 2), predictor.predict(data, np.full(6, 2)))
+
+
+def test_regression_matches_reference(regression_model):
+    path, arrays = regression_model
+    predictor = NumpyPredictor(path)
+    rng = np.random.RandomState(4)
+    data = rng.randn(30, dim).astype(np.float32)
+    task_ind = rng.randint(0, num_task, 30)
+    hidden = np.maximum(np.dot(data, arrays['input_hidden_weights']), 0)
+    features = np.concatenate([hidden, arrays['task_embedding_vectors'][task_ind]], 1)
+    expected = np.einsum('sf,sf->s', features, arrays['hidden_output_weight'][task_ind, :, 0])
+    np.testing.assert_allclose(predictor.predict(data, task_ind), expected, rtol=1e-4, atol=1e-4)
+    label = expected + rng.randn(30)
+    squared_error = (expected - label) ** 2
+    expected_errors = [np.mean(squared_error[task_ind == task]) for task in range(num_task)]
+    np.testing.assert_allclose(predictor.errors(data, task_ind, label),
+                               [expected_errors + [np.mean(expected_errors)]], rtol=1e-4)
+
+
+@pytest.mark.parametrize('task_ind', [-1, num_task, [0, num_task + 2, 1, -3]])
+def test_out_of_range_task_ids_raise(classification_path, task_ind):
+    predictor = NumpyPredictor(classification_path)
+    data = np.zeros([1 if np.ndim(task_ind) == 0 else len(task_ind), dim], dtype=np.float32)
+    with pytest.raises(ValueError, match='task ids'):
+        predictor.predict(data, task_ind)
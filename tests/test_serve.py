@@ -0,0 +1,110 @@
+import http.client
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from benchmarks import make_exported_model
+from predictor import NumpyPredictor
+from serve import MicroBatcher, make_server
+
+
+num_task, num_class, dim = 3, 5, 12
+
+
+@pytest.fixture
+def predictor(tmp_path):
+    path = str(tmp_path / 'model.hgnn')
+    make_exported_model(path, num_task, num_class, dim, 10, 4)
+    return NumpyPredictor(path)
+
+
+class RecordingPredictor:
+    # the wrapped predictor, with the number of rows of every batch it scored
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.input_hidden_weights = predictor.input_hidden_weights
+        self.num_task = predictor.num_task
+        self.batch_rows = []
+
+    def predict(self, data, task_ind):
+        self.batch_rows.append(data.shape[0])
+        return self.predictor.predict(data, task_ind)
+
+
+def test_micro_batches_are_capped_and_answered_in_order(predictor):
+    recording = RecordingPredictor(predictor)
+    # a long wait, so the concurrent requests pile up and have to be split by size
+    batcher = MicroBatcher(recording, max_batch_size=8, max_wait=0.05)
+    sizes = [3] * 10 + [20]
+    requests = [(np.random.RandomState(i).randn(size, dim).astype(np.float32), i % num_task)
+                for i, size in enumerate(sizes)]
+    results = [None] * len(requests)
+
+    def call(i):
+        results[i] = batcher.predict(*requests[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(requests))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        batcher.close()
+    for (data, task), result in zip(requests, results):
+        np.testing.assert_array_equal(result, predictor.predict(data, task))
+    assert sum(recording.batch_rows) == sum(sizes)
+    # only the 20-row request may exceed the cap, and it is scored on its own
+    assert all(rows <= 8 or rows == 20 for rows in recording.batch_rows)
+    assert recording.batch_rows.count(20) == 1
+    stats = batcher.get_stats()
+    assert stats['requests'] == len(requests) and stats['batches'] == len(recording.batch_rows)
+
+
+@pytest.mark.parametrize('task_ind', [num_task, -1, 1.7, [0, 'a']])
+def test_bad_task_ids_raise(predictor, task_ind):
+    batcher = MicroBatcher(predictor)
+    try:
+        with pytest.raises(ValueError, match='task ids'):
+            batcher.predict(np.zeros([2, dim], dtype=np.float32), task_ind)
+    finally:
+        batcher.close()
+
+
+@pytest.fixture
+def server(predictor):
+    batcher = MicroBatcher(predictor, max_batch_size=16, max_wait=0.001)
+    server = make_server(batcher, '127.0.0.1', 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    batcher.close()
+
+
+def post(server, body):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request('POST', '/predict', body if isinstance(body, str) else json.dumps(body))
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_localhost_predict(server, predictor):
+    data = np.random.RandomState(0).randn(4, dim).astype(np.float32)
+    status, body = post(server, {'data': data.tolist(), 'task': [0, 1, 2, 0]})
+    assert status == 200
+    assert body['prediction'] == predictor.predict(data, [0, 1, 2, 0]).tolist()
+
+
+@pytest.mark.parametrize('body', ['not json', {'task': 0}, {'data': [[1, 2]], 'task': 0},
+                                  {'data': [[0.] * dim], 'task': num_task}, {'data': [[0.] * dim], 'task': 1.7}])
+def test_localhost_rejects_malformed_requests(server, body):
+    status, response = post(server, body)
+    assert status == 400
+    assert 'error' in response